@@ -0,0 +1,14 @@
+import numpy as np
+
+
+def intersect_sorted(a, b):
+    '''
+        Пересечение двух отсортированных массивов без повторов (номеров строк эталона).
+        Элементы меньшего массива ищутся в большем двоичным поиском.
+    '''
+    if len(a) > len(b):
+        a, b = b, a
+    if len(a) == 0:
+        return a
+    pos = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    return a[b[pos] == a]
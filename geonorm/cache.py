@@ -0,0 +1,93 @@
+import sys
+import threading
+from collections import OrderedDict
+
+
+def deep_sizeof(obj):
+    '''
+        Приблизительный размер объекта в байтах вместе с вложенными словарями, списками и строками.
+    '''
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k) + deep_sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(i) for i in obj)
+    return size
+
+
+class LRUCache:
+    '''
+        Ограниченный кэш с вытеснением давно не использованных записей (LRU).
+        Размер задаётся числом записей (maxsize) и/или оценкой занимаемой памяти в байтах (maxbytes).
+        Безопасен для использования из нескольких потоков.
+    '''
+    def __init__(self, maxsize=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.data = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = deep_sizeof(key) + deep_sizeof(value) if self.maxbytes else 0
+        with self.lock:
+            if key in self.data:
+                self.bytes -= self.sizes.pop(key)
+                del self.data[key]
+            self.data[key] = value
+            self.sizes[key] = size
+            self.bytes += size
+
+            while self.data and (
+                (self.maxsize is not None and len(self.data) > self.maxsize) or
+                (self.maxbytes is not None and self.bytes > self.maxbytes)
+            ):
+                old_key, _ = self.data.popitem(last=False)
+                self.bytes -= self.sizes.pop(old_key)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.bytes = 0
+
+    def __getstate__(self):
+        # блокировка не сериализуется, копия (например, в процессе, созданном через spawn) получает новую
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.data),
+            'bytes': self.bytes,
+            'hit_ratio': self.hits / requests if requests else 0
+        }
@@ -0,0 +1,65 @@
+import argparse
+import logging
+import pandas as pd
+from .stream import normalize_file
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='geonorm', description='Нормализация адресов')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    normalize = commands.add_parser('normalize', help='потоковая нормализация CSV/Parquet файла')
+    normalize.add_argument('input', help='входной файл: .csv или .parquet')
+    normalize.add_argument('output', help='выходной файл .csv или директория .parquet')
+    normalize.add_argument('--chunksize', type=int, default=100000, help='строк в куске')
+    normalize.add_argument('--matcher', choices=['geonormaliser', 'geomatch'], default='geonormaliser')
+    normalize.add_argument('--standard', default=None, help='эталон (CSV с разделителем ";", можно в zip); по умолчанию встроенный')
+    normalize.add_argument('--geomatch-index', default=None, help='директория с эталоном, сохранённым Geomatch.save')
+    normalize.add_argument('--columns', default='region,settlement,municipality', help='адресные элементы поиска через запятую')
+    normalize.add_argument('--address-column', default=None, help='столбец с адресной строкой для декомпозиции')
+    normalize.add_argument('--keep-columns', default='', help='столбцы входного файла, которые переносятся в результат')
+    normalize.add_argument('--sep', default=';', help='разделитель CSV')
+    normalize.add_argument('--format', choices=['csv', 'parquet'], default=None, help='формат результата; по умолчанию по расширению')
+    normalize.add_argument('--workers', type=int, default=1, help='число процессов')
+    normalize.add_argument('--speller', default='local', help="спеллер Geonormaliser: 'local' или 'yandex'")
+    normalize.add_argument('--no-resume', action='store_true', help='начать заново, игнорируя контрольную точку')
+    return parser
+
+
+def get_matcher(args):
+    columns = [column for column in args.columns.split(',') if column]
+    if args.matcher == 'geomatch' and args.geomatch_index:
+        from .geomatch import Geomatch
+        return Geomatch.load(args.geomatch_index)
+
+    standard = False
+    if args.standard:
+        standard = pd.read_csv(args.standard, sep=';', dtype=str, keep_default_na=False)
+    if args.matcher == 'geomatch':
+        from .geomatch import Geomatch
+        return Geomatch(standard_db=standard, match_columns=columns)
+    from .geonormaliser import Geonormaliser
+    return Geonormaliser(standard_db=standard, match_columns=columns, speller=args.speller)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = get_parser().parse_args(argv)
+    if args.command == 'normalize':
+        rows = normalize_file(
+            get_matcher(args),
+            args.input,
+            args.output,
+            chunksize=args.chunksize,
+            address_column=args.address_column,
+            keep_columns=[column for column in args.keep_columns.split(',') if column],
+            sep=args.sep,
+            output_format=args.format,
+            n_workers=args.workers,
+            resume=not args.no_resume
+        )
+        logging.info(f'normalized {rows} rows')
+
+
+if __name__ == '__main__':
+    main()
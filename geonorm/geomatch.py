@@ -1,10 +1,124 @@
 import pandas as pd
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 import pathlib
 import logging
-from copy import copy
+import json
+import os
+import threading
+from collections import Counter
 import numpy as np
+from scipy.sparse import csr_matrix
+from .cache import LRUCache
+from .array_utils import intersect_sorted
+from .text_utils import fold_text
+from .parallel import normalize_parallel
+
+
+def top_n_indices(scores, top_n):
+    '''
+        Индексы top_n наибольших значений в каждой строке матрицы scores, по убыванию.
+        Вместо полной сортировки используется частичный отбор argpartition.
+    '''
+    top_n = min(top_n, scores.shape[1])
+    if top_n == 0:
+        return np.empty((scores.shape[0], 0), dtype=int)
+    top = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+# результат topk: номер ключа поля и его близость
+TOP_DTYPE = np.dtype([('key', np.int64), ('score', np.float64)])
+
+
+def top_k(scores, k):
+    '''
+        k лучших значений в каждой строке плотной или разреженной (csr) матрицы scores, по убыванию.
+        Возвращает структурированный массив (n_rows, k) с полями key и score.
+        Если в строке меньше k значений (для разреженной матрицы - ненулевых), остаток заполняется key = -1, score = 0.
+    '''
+    out = np.zeros((scores.shape[0], k), dtype=TOP_DTYPE)
+    out['key'] = -1
+    if isinstance(scores, np.ndarray):
+        top = top_n_indices(scores, k)
+        out['key'][:, :top.shape[1]] = top
+        out['score'][:, :top.shape[1]] = np.take_along_axis(scores, top, axis=1)
+        return out
+
+    scores = scores.tocsr()
+    for i in range(scores.shape[0]):
+        keys = scores.indices[scores.indptr[i]:scores.indptr[i + 1]]
+        data = scores.data[scores.indptr[i]:scores.indptr[i + 1]]
+        if len(keys) > k:
+            top = np.argpartition(-data, k - 1)[:k]
+            keys, data = keys[top], data[top]
+        order = np.argsort(-data)
+        out['key'][i, :len(keys)] = keys[order]
+        out['score'][i, :len(keys)] = data[order]
+
+    return out
+
+
+class NgramIndex:
+    '''
+        Инвертированный индекс по символьным n-граммам ключей одного поля.
+        Для запроса отбирает n_candidates ключей с наибольшим числом общих n-грамм,
+        близость по tf-idf затем считается точно, но только для них.
+        Короткие n-граммы (в т.ч. одиночные символы) встречаются почти во всех ключах, поэтому в индекс не попадают.
+    '''
+    def __init__(self, vectorizer, vectors, n_candidates=100, min_ngram=3):
+        self.n_candidates = n_candidates
+        names = vectorizer.get_feature_names_out()
+        self.features = np.flatnonzero(np.array([len(name) >= min_ngram for name in names]))
+        # признак -> ключи, в которых он встречается
+        self.postings = vectors[:, self.features].T.tocsr()
+        self.postings.data[:] = 1
+
+    def to_arrays(self):
+        return {
+            'features': self.features,
+            'postings_data': self.postings.data,
+            'postings_indices': self.postings.indices,
+            'postings_indptr': self.postings.indptr,
+            'postings_shape': np.array(self.postings.shape),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, n_candidates=100):
+        index = cls.__new__(cls)
+        index.n_candidates = n_candidates
+        index.features = arrays['features']
+        index.postings = csr_matrix(
+            (arrays['postings_data'], arrays['postings_indices'], arrays['postings_indptr']),
+            shape=tuple(arrays['postings_shape'])
+        )
+        return index
+
+    def candidates(self, vec):
+        query = vec[:, self.features]
+        query.data[:] = 1
+        hits = (query @ self.postings).tocsr()
+
+        out = []
+        for i in range(hits.shape[0]):
+            keys = hits.indices[hits.indptr[i]:hits.indptr[i + 1]]
+            counts = hits.data[hits.indptr[i]:hits.indptr[i + 1]]
+            if len(keys) > self.n_candidates:
+                keys = keys[np.argpartition(-counts, self.n_candidates - 1)[:self.n_candidates]]
+            out.append(keys)
+
+        return out
+
+    def similarity(self, vec, vectors):
+        '''
+            Разреженная матрица близости (n_queries, n_keys), заполненная только для кандидатов.
+        '''
+        candidates = self.candidates(vec)
+        rows = np.repeat(np.arange(len(candidates)), [len(keys) for keys in candidates])
+        cols = np.concatenate(candidates) if candidates else np.empty(0, dtype=int)
+        data = np.asarray(vec[rows].multiply(vectors[cols]).sum(axis=1)).ravel()
+
+        return csr_matrix((data, (rows, cols)), shape=(vec.shape[0], vectors.shape[0]))
 
 
 class Geomatch:
@@ -16,7 +130,13 @@ class Geomatch:
                  debug=False,
                  skip_dead_end_fields=0,
                  rearrange_score=0.9,
-                 filter_by_prev=True
+                 filter_by_prev=True,
+                 batch_size=256,
+                 score_bytes=2 ** 27,
+                 n_candidates=None,
+                 candidate_index=NgramIndex,
+                 cache_size=None,
+                 cache_bytes=None
                  ):
         self.current_directory = str(pathlib.Path(__file__).parent.resolve())
 
@@ -45,98 +165,525 @@ class Geomatch:
         self.skip_dead_end_fields = skip_dead_end_fields
         self.vectorizers = {}
         self.vectors = {}
-        self.ids = {}
+        self.key_rows = {}
         self.keys = {}
         self.field_ids = {}
-        self.filter_ids = None
-        self.match_columns = match_columns
-        self.base_match_columns = match_columns
+        self.candidate_indexes = {}
+        self.sub_keys = {}
+        self.exact = {}
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        # после инициализации состояние не меняется, поэтому один экземпляр можно использовать из нескольких потоков
+        self.match_columns = list(match_columns)
         # self.standard = self.standard  # [self.match_columns]
         self.filter_by_prev = filter_by_prev
+        # сколько строк датафрейма векторизуется и сравнивается с эталоном за один проход
+        self.batch_size = batch_size
+        # память под матрицу близости одного прохода, по ней пачка делится на блоки (score_rows)
+        self.score_bytes = score_bytes
+        self.n_candidates = n_candidates
+        self.init_cache(cache_size, cache_bytes)
 
 
         # todo: протестировать другие варианты
         # инициализируем tfidf по каждой колонке
         for field in self.match_columns:
-            self.ids[field] = self.standard.reset_index().groupby(field)['index'].apply(list).to_dict()
-            self.keys[field] = list(self.ids[field].keys())
-            self.field_ids[field] = list(self.ids[field].values())
-            self.field_ids[field] = {value: k for k, v in enumerate(self.field_ids[field]) for value in self.field_ids[field][k]}
+            # field_ids - номер ключа для каждой строки эталона,
+            # key_rows - строки эталона каждого ключа в формате (indptr, rows), как в csr-матрице
+            field_ids, keys = pd.factorize(self.standard[field], sort=True)
+            self.keys[field] = keys.tolist()
+            self.field_ids[field] = field_ids.astype(np.int32)
+            rows = np.argsort(self.field_ids[field], kind='stable').astype(np.int32)
+            indptr = np.concatenate([[0], np.cumsum(np.bincount(self.field_ids[field], minlength=len(keys)))])
+            self.key_rows[field] = (indptr.astype(np.int64), rows)
+
+            self.build_exact(field, [fold_text(key) for key in self.keys[field]])
 
             self.vectorizers[field] = TfidfVectorizer(ngram_range=(1, 4), analyzer='char_wb')
             self.vectors[field] = self.vectorizers[field].fit_transform(self.keys[field])
 
-            # print(self.standard.groupby(field)['index'].apply(list).to_dict())
-            # print(len(self.ids[field]))
-
-    def get_output(self, scores, field, top_n=1):
-        out = []
+            # для больших справочников полный перебор заменяем отбором кандидатов
+            if n_candidates and len(self.keys[field]) > n_candidates:
+                self.candidate_indexes[field] = candidate_index(
+                    self.vectorizers[field],
+                    self.vectors[field],
+                    n_candidates=n_candidates
+                )
+
+        if self.filter_by_prev:
+            self.build_sub_keys()
+
+    def __getstate__(self):
+        # блокировка счётчиков не сериализуется (передача в процессы, созданные через spawn)
+        state = self.__dict__.copy()
+        del state['stats_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.stats_lock = threading.Lock()
+
+    def init_cache(self, cache_size=None, cache_bytes=None):
+        '''
+            Кэш результатов process_address: не больше cache_size записей и/или cache_bytes байт.
+            Если оба ограничения не заданы, кэш не используется.
+        '''
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.cache = None
+        if cache_size or cache_bytes:
+            self.cache = LRUCache(maxsize=cache_size, maxbytes=cache_bytes)
+
+    def cache_key(self, values):
+        '''
+            Ключ кэша: значения match_columns (None - поля нет во входных данных) и параметры поиска.
+            Регистр и пробелы на результат не влияют, поэтому в ключе они приведены к единому виду.
+        '''
+        return (
+            tuple(None if value is None else ' '.join(str(value).lower().split()) for value in values),
+            self.skip_dead_end_fields,
+            self.rearrange_score,
+            self.filter_by_prev,
+            tuple(sorted(self.threshold.items()))
+        )
 
-        if scores is None:
-            out = [[{'name': '', 'score': 0, 'ids': set()}]]
-        else:
-            for score in scores:
-                row = []
-                for i in (-score).argsort()[:top_n]:
-                    id = i
-                    if self.filter_ids:
-                        id = self.get_filter_ids(field)[i]
-
-                    curr_key = self.keys[field][id]
-                    ids = self.ids[field][curr_key]
-                    row.append({
-                        'id': id,
-                        'name': curr_key,
-                        'score': score[i],
-                        'ids': set(ids)
-                    })
-                out.append(row)
+    def cache_stats(self):
+        '''
+            Статистика кэша результатов: hits, misses, evictions, size, bytes, hit_ratio.
+        '''
+        return self.cache.stats() if self.cache is not None else {}
+
+    def build_exact(self, field, normalized_keys, indptr=None, ids=None):
+        '''
+            Индекс точного совпадения: нормализованное значение -> номера ключей поля,
+            в формате (словарь значение -> номер группы, indptr, ids), как в csr-матрице.
+        '''
+        if indptr is None:
+            groups, exact_keys = pd.factorize(pd.Series(normalized_keys, dtype=object))
+            ids = np.argsort(groups, kind='stable').astype(np.int32)
+            indptr = np.concatenate([[0], np.cumsum(np.bincount(groups, minlength=len(exact_keys)))])
+            normalized_keys = exact_keys.tolist()
+        self.exact[field] = (dict(zip(normalized_keys, range(len(normalized_keys)))), indptr, ids)
+
+    def exact_ids(self, address_field, field):
+        '''
+            Номера ключей поля (по возрастанию), совпадающих с address_field без учёта регистра, ё/е
+            и лишних пробелов (fold_text); пустой массив - совпадений нет. Только такие совпадения
+            получают score 1.0 без подсчёта близости.
+        '''
+        groups, indptr, ids = self.exact[field]
+        normalized = fold_text(address_field)
+        group = groups.get(normalized) if normalized != '' else None
+        if group is None:
+            return ids[:0]
+        return ids[indptr[group]:indptr[group + 1]]
+
+    def get_exact(self, address_field, field, prepared):
+        '''
+            exact_ids поля, найденные один раз за вызов и сохранённые в prepared[field].
+        '''
+        exact, vec, top = prepared.get(field, (None, None, None))
+        if exact is None:
+            exact = self.exact_ids(address_field, field)
+            prepared[field] = (exact, vec, top)
+
+        return exact
+
+    def find_exact(self, address_field, field, key_ids=None, ids=None):
+        '''
+            Номер ключа, совпадающего с address_field после нормализации, или None.
+            key_ids - отсортированные номера ключей, среди которых идёт поиск (фильтр по родителю).
+            ids - уже найденные exact_ids(address_field, field).
+        '''
+        if ids is None:
+            ids = self.exact_ids(address_field, field)
+        if key_ids is not None:
+            ids = intersect_sorted(ids, key_ids)
+        for id in ids:
+            # среди нескольких вариантов предпочитаем буквальное совпадение
+            if self.keys[field][id] == address_field:
+                return id
+        return ids[0] if len(ids) > 0 else None
+
+    def count_path(self, address_dict, prepared, weight=1):
+        '''
+            Учитывает, сколько непустых значений полей нашлось точным совпадением, а сколько ушло в tf-idf.
+            weight - сколько входных строк представляет address_dict (одинаковые строки датафрейма ищутся один раз).
+            Поиск по индексу идёт вне блокировки, под ней только увеличиваются счётчики.
+        '''
+        paths = [
+            (field, 'exact' if len(self.get_exact(address_dict[field], field, prepared)) > 0 else 'tfidf')
+            for field in self.match_columns
+            if field in address_dict and address_dict[field] != ''
+        ]
+        with self.stats_lock:
+            for path in paths:
+                self.stats[path] += weight
+
+    def match_stats(self):
+        '''
+            Счётчики путей поиска по полям: exact - точное совпадение, tfidf - поиск по близости.
+            Считаются входные строки, в том числе найденные в кэше результатов.
+        '''
+        stats = pd.DataFrame(
+            [[self.stats[(field, 'exact')], self.stats[(field, 'tfidf')]] for field in self.match_columns],
+            index=self.match_columns,
+            columns=['exact', 'tfidf']
+        )
+        stats['exact_share'] = stats['exact'] / stats.sum(axis=1).where(lambda x: x > 0)
+        return stats
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats.clear()
+
+    def build_sub_keys(self):
+        '''
+            Для каждой пары полей (родитель, потомок) заранее считает ключи потомка, встречающиеся
+            вместе с каждым ключом родителя, в формате (indptr, indices), как в csr-матрице.
+            Поиск с фильтром по найденному родителю берёт готовый срез без построения множеств.
+        '''
+        for parent in self.match_columns:
+            for child in self.match_columns:
+                if parent == child:
+                    continue
+                n_child = len(self.keys[child])
+                pairs = np.unique(self.field_ids[parent].astype(np.int64) * n_child + self.field_ids[child])
+                indptr = np.concatenate([[0], np.cumsum(np.bincount(pairs // n_child, minlength=len(self.keys[parent])))])
+                self.sub_keys[(parent, child)] = (indptr, (pairs % n_child).astype(np.int32))
+
+    def save(self, path):
+        '''
+            Сохраняет проиндексированный эталон в директорию path: параметры и словари в meta.json,
+            массивы (csr-матрицы tf-idf, индексы строк, эталон по столбцам) - в .npy,
+            чтобы Geomatch.load мог отобразить их в память без повторного обучения.
+        '''
+        os.makedirs(path, exist_ok=True)
+        meta = {
+            'version': 1,
+            'match_columns': self.match_columns,
+            'threshold': self.threshold,
+            'skip_dead_end_fields': self.skip_dead_end_fields,
+            'rearrange_score': self.rearrange_score,
+            'filter_by_prev': self.filter_by_prev,
+            'batch_size': self.batch_size,
+            'score_bytes': self.score_bytes,
+            'n_candidates': self.n_candidates,
+            'cache_size': self.cache_size,
+            'cache_bytes': self.cache_bytes,
+            'standard_columns': [],
+            'fields': []
+        }
 
-        return out
+        for i, column in enumerate(self.standard.columns):
+            codes, categories = pd.factorize(self.standard[column])
+            np.save(pathlib.Path(f'{path}/standard_{i}.npy'), codes.astype(np.int32))
+            meta['standard_columns'].append({'name': column, 'categories': categories.tolist()})
+
+        for i, field in enumerate(self.match_columns):
+            vectorizer = self.vectorizers[field]
+            vectors = self.vectors[field]
+            arrays = {
+                'field_ids': self.field_ids[field],
+                'key_rows_indptr': self.key_rows[field][0],
+                'key_rows': self.key_rows[field][1],
+                'idf': vectorizer.idf_,
+                'vectors_data': vectors.data,
+                'vectors_indices': vectors.indices,
+                'vectors_indptr': vectors.indptr,
+            }
+            if field in self.candidate_indexes:
+                arrays.update({f'index_{k}': v for k, v in self.candidate_indexes[field].to_arrays().items()})
+            arrays['exact_indptr'] = self.exact[field][1]
+            arrays['exact_ids'] = self.exact[field][2]
+            for j, parent in enumerate(self.match_columns):
+                if (parent, field) in self.sub_keys:
+                    arrays[f'sub_keys_{j}_indptr'] = self.sub_keys[(parent, field)][0]
+                    arrays[f'sub_keys_{j}_indices'] = self.sub_keys[(parent, field)][1]
+            for name, array in arrays.items():
+                np.save(pathlib.Path(f'{path}/field_{i}_{name}.npy'), array)
+
+            meta['fields'].append({
+                'name': field,
+                'keys': self.keys[field],
+                'exact_keys': list(self.exact[field][0]),
+                'exact_normalization': 'fold_text',
+                'features': vectorizer.get_feature_names_out().tolist(),
+                'arrays': list(arrays)
+            })
+
+        with open(pathlib.Path(f'{path}/meta.json'), 'w', encoding='utf-8') as fp:
+            json.dump(meta, fp, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path, mmap=True, candidate_index=NgramIndex):
+        '''
+            Загружает эталон, сохранённый Geomatch.save. При mmap=True массивы отображаются в память,
+            так что несколько процессов используют одну копию данных.
+        '''
+        mmap_mode = 'r' if mmap else None
+        with open(pathlib.Path(f'{path}/meta.json'), 'r', encoding='utf-8') as fp:
+            meta = json.load(fp)
+
+        self = cls.__new__(cls)
+        self.current_directory = str(pathlib.Path(__file__).parent.resolve())
+        self.threshold = meta['threshold']
+        self.skip_dead_end_fields = meta['skip_dead_end_fields']
+        self.rearrange_score = meta['rearrange_score']
+        self.filter_by_prev = meta['filter_by_prev']
+        self.batch_size = meta['batch_size']
+        self.score_bytes = meta.get('score_bytes', 2 ** 27)
+        self.n_candidates = meta['n_candidates']
+        self.init_cache(meta.get('cache_size'), meta.get('cache_bytes'))
+        self.match_columns = meta['match_columns']
+
+        standard = {}
+        for i, column in enumerate(meta['standard_columns']):
+            codes = np.load(pathlib.Path(f'{path}/standard_{i}.npy'))
+            standard[column['name']] = np.array(column['categories'], dtype=object)[codes]
+        self.standard = pd.DataFrame(standard)
 
-    def get_filter_ids(self, field):
-        return np.array(list({self.field_ids[field][i] for i in self.filter_ids}))
+        self.vectorizers = {}
+        self.vectors = {}
+        self.key_rows = {}
+        self.keys = {}
+        self.field_ids = {}
+        self.candidate_indexes = {}
+        self.sub_keys = {}
+        self.exact = {}
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        for i, field_meta in enumerate(meta['fields']):
+            field = field_meta['name']
+            arrays = {
+                name: np.load(pathlib.Path(f'{path}/field_{i}_{name}.npy'), mmap_mode=mmap_mode)
+                for name in field_meta['arrays']
+            }
+            self.keys[field] = field_meta['keys']
+            self.field_ids[field] = arrays['field_ids']
+            self.key_rows[field] = (arrays['key_rows_indptr'], arrays['key_rows'])
+            if field_meta.get('exact_normalization', 'fold_text') == 'fold_text':
+                self.build_exact(field, field_meta['exact_keys'], arrays['exact_indptr'], arrays['exact_ids'])
+            else:
+                # индекс по канонической форме (normalize_text) из предыдущей версии строится заново
+                self.build_exact(field, [fold_text(key) for key in self.keys[field]])
+
+            features = field_meta['features']
+            self.vectorizers[field] = TfidfVectorizer(
+                ngram_range=(1, 4),
+                analyzer='char_wb',
+                vocabulary=dict(zip(features, range(len(features))))
+            )
+            self.vectorizers[field].idf_ = arrays['idf']
+            self.vectors[field] = csr_matrix(
+                (arrays['vectors_data'], arrays['vectors_indices'], arrays['vectors_indptr']),
+                shape=(len(self.keys[field]), len(features))
+            )
 
-    def find_similar_records(self, data, field):
-        vec = self.vectorizers[field].transform(data).toarray()
+            index_arrays = {k[len('index_'):]: v for k, v in arrays.items() if k.startswith('index_')}
+            if index_arrays:
+                self.candidate_indexes[field] = candidate_index.from_arrays(index_arrays, n_candidates=self.n_candidates)
+            for j, parent in enumerate(self.match_columns):
+                if f'sub_keys_{j}_indptr' in arrays:
+                    self.sub_keys[(parent, field)] = (arrays[f'sub_keys_{j}_indptr'], arrays[f'sub_keys_{j}_indices'])
+
+        return self
+
+    def get_ids(self, field, key_id):
+        indptr, rows = self.key_rows[field]
+        return rows[indptr[key_id]:indptr[key_id + 1]]
+
+    def topk(self, field, queries, k=1):
+        '''
+            k ближайших ключей поля для каждой строки queries.
+            Возвращает структурированный массив (len(queries), k) с полями key (номер в self.keys[field]) и score.
+            Строки эталона по ключу при необходимости достаются через get_ids(field, key).
+        '''
+        out = []
         vectors = self.vectors[field]
-        if self.filter_ids:
-            vectors = vectors[self.get_filter_ids(field), :]
+        step = self.score_rows(field)
+        for start in range(0, len(queries), self.batch_size):
+            vec = self.vectorizers[field].transform(queries[start:start + self.batch_size])
+            for offset in range(0, vec.shape[0], step):
+                if field in self.candidate_indexes:
+                    scores = self.candidate_indexes[field].similarity(vec[offset:offset + step], vectors)
+                else:
+                    scores = (vectors @ vec[offset:offset + step].T).T.tocsr()
+                out.append(top_k(scores, k))
+
+        if not out:
+            return np.zeros((0, k), dtype=TOP_DTYPE)
+        return np.concatenate(out)
+
+    def get_output(self, scores, field, top_n=1, key_ids=None):
+        '''
+            key_ids - номера ключей, соответствующие столбцам scores, если поиск шёл не по всем ключам поля
+            ids в результате - срез массива строк эталона (get_ids), без копирования
+        '''
+        if scores is None:
+            return [[{'name': '', 'score': 0, 'ids': np.empty(0, dtype=np.int32)}]]
 
-        out = cosine_similarity(
-            vec,
-            vectors
-        )
+        return self.top_output(top_k(scores, top_n), field, key_ids)
+
+    def top_output(self, tops, field, key_ids=None):
+        '''
+            Результат поиска по уже отобранным лучшим ключам tops (структурированный массив, как у top_k).
+        '''
+        out = []
+        for top in tops:
+            row = []
+            for id, score in top[top['key'] >= 0]:
+                if key_ids is not None:
+                    id = key_ids[id]
+
+                row.append({
+                    'id': id,
+                    'name': self.keys[field][id],
+                    'score': score,
+                    'ids': self.get_ids(field, id)
+                })
+            out.append(row)
 
         return out
 
+    def get_filter_ids(self, field, filter_key):
+        parent, parent_id = filter_key
+        indptr, indices = self.sub_keys[(parent, field)]
+        return indices[indptr[parent_id]:indptr[parent_id + 1]]
+
+    def similarity(self, vec, field, key_ids=None):
+        '''
+            Близость векторов запросов к ключам поля: ко всем, к кандидатам из индекса или только к key_ids.
+        '''
+        vectors = self.vectors[field]
+        # векторы tf-idf нормированы (l2), поэтому скалярное произведение равно косинусной близости;
+        # произведение считается как (vectors @ vec.T).T: vec @ vectors.T заставляет scipy
+        # при каждом вызове переводить транспонированную матрицу всех ключей поля в csr
+        if key_ids is not None:
+            return (vectors[key_ids, :] @ vec.T).T.toarray()
+        if field in self.candidate_indexes:
+            return self.candidate_indexes[field].similarity(vec, vectors).toarray()
+
+        return (vectors @ vec.T).T.toarray()
+
+    def score_rows(self, field):
+        '''
+            Сколько запросов сравнивается с ключами поля за один проход, чтобы разреженное произведение
+            и его плотная копия (около 20 байт на пару запрос-ключ) укладывались в score_bytes.
+        '''
+        return max(1, self.score_bytes // (20 * max(1, len(self.keys[field]))))
+
+    def top_scores(self, vec, field):
+        '''
+            Лучший ключ поля для каждой строки vec: близость считается блоками по score_rows строк,
+            от каждого блока остаётся только top_k, так что полная матрица близости в памяти не держится.
+        '''
+        step = self.score_rows(field)
+        out = [top_k(self.similarity(vec[start:start + step], field), 1) for start in range(0, vec.shape[0], step)]
+        if not out:
+            return np.zeros((0, 1), dtype=TOP_DTYPE)
+        return np.concatenate(out)
+
+    def find_similar_records(self, data, field, key_ids=None):
+        vec = self.vectorizers[field].transform(data)
+
+        return self.similarity(vec, field, key_ids)
+
+    def score_batch(self, df):
+        '''
+            Векторизует каждую колонку пачки адресов одним вызовом transform и возвращает для каждой строки
+            словарь prepared {field: (exact, vec, top)}: точные совпадения (exact_ids), вектор и лучший ключ поля
+            по близости (см. top_scores). Для значений, которые находятся точным совпадением, близость не считается.
+        '''
+        prepared = [{} for _ in range(len(df))]
+        for field in self.match_columns:
+            if field in df:
+                values = df[field].tolist()
+                rows = [
+                    i for i, value in enumerate(values)
+                    if value != '' and len(self.get_exact(value, field, prepared[i])) == 0
+                ]
+                if not rows:
+                    continue
+                vec = self.vectorizers[field].transform([values[i] for i in rows])
+                for j, (i, top) in enumerate(zip(rows, self.top_scores(vec, field))):
+                    prepared[i][field] = (prepared[i][field][0], vec[j], top)
+
+        return prepared
+
     def return_matched_rows(self, ids, max_rows=1):
-        if ids:
-            selected_record = list(ids)[0]
+        if len(ids) > 0:
+            selected_record = ids[0]
             return dict(self.standard.iloc[selected_record])
         else:
             return {i: '' for i in self.match_columns}
 
-    def find_in_field(self, address_field, field, top_n=5):
-        scores = None
-        if address_field != '':
-            scores = self.find_similar_records([address_field], field)
+    def prepare_field(self, address_field, field, prepared):
+        '''
+            Вектор address_field и лучший по близости ключ поля (строка top_k). Считаются один раз за вызов
+            process_address и сохраняются в prepared, чтобы не повторяться при следующих сдвигах match_columns.
+        '''
+        exact, vec, top = prepared.get(field, (None, None, None))
+        if vec is None:
+            vec = self.vectorizers[field].transform([address_field])
+        if top is None:
+            top = self.top_scores(vec, field)[0]
+        prepared[field] = (exact, vec, top)
+
+        return vec, top
+
+    def find_in_field(self, address_field, field, top_n=1, prepared=None, filter_key=None):
+        '''
+            prepared - уже найденные точные совпадения, векторы полей адреса и лучшие ключи по близости
+            {field: (exact, vec, top)}, см. score_batch, get_exact и prepare_field; дополняется по ходу поиска
+            filter_key - (поле, номер ключа) найденного на предыдущем шаге родителя, поиск идёт только среди его потомков
+        '''
+        if prepared is None:
+            prepared = {}
+        key_ids = None
+        if filter_key is not None:
+            key_ids = self.get_filter_ids(field, filter_key)
+
+        exact_id = None
+        if address_field != '' and top_n == 1:
+            exact_id = self.find_exact(address_field, field, key_ids, self.get_exact(address_field, field, prepared))
+
+        if address_field == '':
+            scores = None
+        elif exact_id is not None:
+            # точное совпадение: близость не считаем
+            return [[{'id': exact_id, 'name': self.keys[field][exact_id], 'score': 1.0, 'ids': self.get_ids(field, exact_id)}]]
+        elif key_ids is None and top_n == 1:
+            vec, top = self.prepare_field(address_field, field, prepared)
+            return self.top_output(top.reshape(1, -1), field)
+        else:
+            # внутри фильтра близость считается только к ключам-потомкам
+            exact, vec, top = prepared.get(field, (None, None, None))
+            if vec is None:
+                vec = self.vectorizers[field].transform([address_field])
+                prepared[field] = (exact, vec, None)
+            scores = self.similarity(vec, field, key_ids)
 
-        return self.get_output(scores, field, top_n)
+        return self.get_output(scores, field, top_n, key_ids)
 
 
 
-    def find_in_fields_by_step(self, address_dict):
+    def find_in_fields_by_step(self, address_dict, prepared=None, match_columns=None):
         if type(address_dict) is list:
             address_dict = self.__to_list_of_dict__(address_dict)
+        if prepared is None:
+            prepared = {}
+        if match_columns is None:
+            match_columns = self.match_columns
 
         out = {}
-        self.filter_ids = None
-        for field in self.match_columns:
+        filter_key = None
+        for field in match_columns:
             if field in address_dict:
-                out[field] = self.find_in_field(address_dict[field], field)
+                out[field] = self.find_in_field(address_dict[field], field, prepared=prepared, filter_key=filter_key)
                 if self.filter_by_prev:
-                    self.filter_ids = out[field][0][0]['ids']
+                    # фильтр по найденному ключу поля; пустое поле фильтр снимает
+                    filter_key = (field, out[field][0][0]['id']) if 'id' in out[field][0][0] else None
 
         return self.__to_dict_of_list__(out)
 
@@ -161,19 +708,18 @@ class Geomatch:
     def filter_by_field_intersection_old(self, search_results):
         results = []
         for search_result in search_results:
-            ids = []
+            ids = None
             skip_dead_end_fields = 0
             curr_query = {
                 'ids': []
             }
             for field in search_result:
                 if self.check_threshold(field, search_result[field][0]['score']):
-                    test_ids = copy(ids)
-                    test_ids.append(search_result[field][0]['ids'])
                     search_result_field = search_result[field][0]
+                    test_ids = search_result_field['ids'] if ids is None else intersect_sorted(ids, search_result_field['ids'])
 
                     # здесь происходит проверка на тупиковые множества
-                    if len(set.intersection(*test_ids)) > 0 or self.skip_dead_end_fields <= skip_dead_end_fields:
+                    if len(test_ids) > 0 or self.skip_dead_end_fields <= skip_dead_end_fields:
                         ids = test_ids
                     else:
                         skip_dead_end_fields += 1
@@ -192,8 +738,8 @@ class Geomatch:
                 # curr_query[f'{field}_name'] = search_result_field['name']
                 # curr_query[f'{field}_score'] = search_result_field['score']
 
-            if len(ids) > 0:
-                curr_query['ids'] = set.intersection(*ids)
+            if ids is not None:
+                curr_query['ids'] = ids
             curr_query['results'] = len(curr_query['ids'])
             curr_query['skiped_dead_end_fields'] = skip_dead_end_fields
 
@@ -202,7 +748,8 @@ class Geomatch:
         return results
 
     def filter_by_fields_intersections(self, search_result, fields):
-        ids = []
+        # ids - пересечение строк эталона по принятым полям (отсортированный массив), None - пока ни одного
+        ids = None
         total_score = 0
         used_fields = 0
         skip_dead_end_fields = 0
@@ -222,10 +769,9 @@ class Geomatch:
             }
 
             if self.check_threshold(field, search_result_field['score']):
-                test_ids = copy(ids)
-                test_ids.append(search_result_field['ids'])
+                test_ids = search_result_field['ids'] if ids is None else intersect_sorted(ids, search_result_field['ids'])
 
-                if len(set.intersection(*test_ids)) > 0 or self.skip_dead_end_fields <= skip_dead_end_fields:
+                if len(test_ids) > 0 or self.skip_dead_end_fields <= skip_dead_end_fields:
                     total_score += search_result_field['score']
                     used_fields += 1
                     out_fields[field]['status'] = 'OK'
@@ -234,8 +780,8 @@ class Geomatch:
                     out_fields[field]['status'] = 'DEAD_END_SKIP'
                     skip_dead_end_fields += 1
 
-        if len(ids) > 0:
-            curr_query['ids'] = set.intersection(*ids)
+        if ids is not None:
+            curr_query['ids'] = ids
 
         curr_query['results'] = len(curr_query['ids'])
         curr_query['skiped_dead_end_fields'] = skip_dead_end_fields
@@ -263,32 +809,108 @@ class Geomatch:
 
         return result
 
-    def __extract_result(self, row):
-        return self.process_address(row.to_dict())
-
     def process_df(self, df):
-        return df.apply(self.__extract_result, axis=1, result_type="expand")
-
-    def find_best_result(self, address_dict):
-        matches = self.find_in_fields_by_step(address_dict)
+        '''
+            Пакетный мэтчинг. Одинаковые (с точностью до регистра и пробелов) наборы значений match_columns
+            ищутся один раз, результат размножается на все такие строки; найденное ранее берётся из кэша.
+            Для остальных близость считается сразу для batch_size строк,
+            дальше по каждой строке выполняется только выбор лучшего варианта.
+        '''
+        values = [
+            df[field].astype(str).str.lower().str.split().str.join(' ') if field in df else [None] * len(df)
+            for field in self.match_columns
+        ]
+        codes, uniques = pd.factorize(pd.Series(list(zip(*values)), dtype=object))
+        unique_df = df.iloc[np.unique(codes, return_index=True)[1]]
+        # сколько строк df приходится на каждый уникальный набор - для счётчиков match_stats
+        sizes = np.bincount(codes, minlength=len(uniques))
+
+        results = [None] * len(unique_df)
+        todo = []
+        for i, unique_values in enumerate(uniques):
+            if self.cache is not None:
+                results[i] = self.cache.get(self.cache_key(unique_values))
+            if results[i] is None:
+                todo.append(i)
+            else:
+                self.count_path(unique_df.iloc[i].to_dict(), {}, sizes[i])
+
+        for start in range(0, len(todo), self.batch_size):
+            batch_rows = todo[start:start + self.batch_size]
+            batch = unique_df.iloc[batch_rows]
+            prepared = self.score_batch(batch)
+            for i, address_dict in enumerate(batch.to_dict('records')):
+                self.count_path(address_dict, prepared[i], sizes[batch_rows[i]])
+                results[batch_rows[i]] = self.match_address(address_dict, prepared[i])
+                if self.cache is not None:
+                    self.cache.put(self.cache_key(uniques[batch_rows[i]]), results[batch_rows[i]])
+
+        return pd.DataFrame([results[code] for code in codes], index=df.index)
+
+    def find_best_result(self, address_dict, prepared=None, match_columns=None):
+        matches = self.find_in_fields_by_step(address_dict, prepared, match_columns)
         intersection = self.filter_by_field_intersection(matches)
 
         return self.output_data(intersection)
 
-    def process_address(self, address_dict):
+    def upper_bound(self, address_dict, prepared):
+        '''
+            Верхняя оценка score при любом порядке полей: score усредняется по полям,
+            а в каждом поле близость не превосходит максимальной близости по всем его ключам.
+        '''
+        bound = 0
+        for field in self.match_columns:
+            if field in address_dict and address_dict[field] != '':
+                # при точном совпадении близость максимальна
+                if len(self.get_exact(address_dict[field], field, prepared)) > 0:
+                    bound = max(bound, 1.0)
+                    continue
+                # по индексу кандидатов точный максимум неизвестен
+                if field in self.candidate_indexes:
+                    return np.inf
+                vec, top = self.prepare_field(address_dict[field], field, prepared)
+                bound = max(bound, top['score'][0])
+
+        return bound
+
+    def process_address(self, address_dict, prepared=None):
+        if prepared is None:
+            prepared = {}
+        self.count_path(address_dict, prepared)
+        if self.cache is None:
+            return self.match_address(address_dict, prepared)
+
+        key = self.cache_key(address_dict.get(field) for field in self.match_columns)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.match_address(address_dict, prepared)
+            self.cache.put(key, result)
+
+        return dict(result)
+
+    def match_address(self, address_dict, prepared=None):
+        '''
+            Перебирает циклические сдвиги match_columns (каждый задаёт свой порядок фильтрации)
+            и возвращает лучший результат. Порядок полей и фильтры живут только внутри вызова.
+            Близость по каждому полю считается один раз и переиспользуется всеми сдвигами.
+        '''
+        if prepared is None:
+            prepared = {}
         curr_score = 0
-        for i in range(len(self.match_columns)):
-            f = self.match_columns.pop(0)
-            self.match_columns.append(f)
-            self.filter_ids = False
-            curr_result = self.find_best_result(address_dict)
-            if curr_result['score'] > curr_score:
+        result = None
+        n = len(self.match_columns)
+        for i in range(1, n + 1):
+            # следующие сдвиги не нужны, если ни один из них не может превзойти текущий результат
+            if result is not None and self.upper_bound(address_dict, prepared) <= curr_score:
+                break
+            match_columns = self.match_columns[i % n:] + self.match_columns[:i % n]
+            curr_result = self.find_best_result(address_dict, prepared, match_columns)
+            if result is None or curr_result['score'] > curr_score:
                 curr_score = curr_result['score']
                 result = curr_result
             if curr_score > self.rearrange_score:
                 break
 
-        self.match_columns = self.base_match_columns
         return result
 
     def __to_dict_of_list__(self, dict_of_list):
@@ -297,6 +919,15 @@ class Geomatch:
     def __to_list_of_dict__(self, list_of_dict):
         return {k: [dic[k] for dic in list_of_dict] for k in list_of_dict[0]}
 
+    def normalize_parallel(self, df, n_workers=None, chunksize=10000):
+        '''
+            Мэтчинг датафрейма в n_workers процессах кусками по chunksize строк, порядок строк сохраняется.
+            Процессы создаются через fork и разделяют с родителем словари, матрицы tf-idf и индексы
+            (после Geomatch.load(mmap=True) - ещё и через общие страницы файлов).
+            Статистика match_stats() и кэш результатов рабочих процессов в родителя не возвращаются.
+        '''
+        return normalize_parallel(self, df, n_workers, chunksize)
+
     def __call__(self, input_data):
         if isinstance(input_data, pd.DataFrame):
             return self.process_df(input_data)
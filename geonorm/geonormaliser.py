@@ -1,9 +1,14 @@
+import numpy as np
 import pandas as pd
 import pathlib
+import logging
 from .geonormaliser_utils import search_reference_address,\
                                  get_pull_methods, get_address_by_level,\
                                  get_optional_parametres, valid_result,\
-                                 load_standard
+                                 load_standard, StandardIndex, get_speller_texts,\
+                                 search_direct_frame, direct_frame_result
+from .speller import get_speller
+from .parallel import normalize_parallel
 
 
 
@@ -15,13 +20,26 @@ class Geonormaliser:
                  match_columns=['region', 'settlement', 'municipality'],
                  use_speller=True,
                  use_levenstein=False,
-                 levenshtein_threshold=10
+                 levenshtein_threshold=10,
+                 speller='local',
+                 speller_cache_size=100000,
+                 speller_cache_path=None
                  ):
         self.current_directory = str(pathlib.Path(__file__).parent.resolve())
         self.standard = load_standard(standard_db, self.current_directory)
         self.match_columns = match_columns
         self.levenshtein_threshold = levenshtein_threshold
         self.pull_methods = get_pull_methods(use_speller, use_levenstein)
+        # индексы значение -> строки эталона, чтобы точный поиск не сканировал весь эталон,
+        # и эталон по столбцам, чтобы поиск шёл по номерам строк без срезов DataFrame
+        self.index = StandardIndex(self.standard, self.match_columns, fuzzy=use_levenstein)
+        # 'local' - офлайн-спеллер по словарю эталона, 'yandex' - HTTP API, либо свой объект с методом check(text);
+        # ответы кэшируются в памяти и, если задан speller_cache_path, на диске
+        if use_speller or use_levenstein:
+            self.speller = get_speller(speller, self.standard, self.match_columns,
+                                       speller_cache_size, speller_cache_path)
+        else:
+            self.speller = None
 
 
 
@@ -34,40 +52,125 @@ class Geonormaliser:
             Получает результат поиска, валидирует его, отдает родительской функции. 
         '''
         address_by_level = get_address_by_level(input_data, self.match_columns)
-        optional = get_optional_parametres(input_data, self.levenshtein_threshold)
-        address_normalize, address_normalize_status = search_reference_address(
+        optional = get_optional_parametres(input_data, self.levenshtein_threshold, self.speller)
+        rows, address_normalize_status = search_reference_address(
                                                             address_by_level, 
-                                                            self.standard, 
+                                                            self.index, 
                                                             self.pull_methods, 
                                                             optional)
-        result = valid_result(address_normalize, address_normalize_status, self.standard)
+        result = valid_result(rows, address_normalize_status, self.index)
         return result
 
     
+    def _prefetch_speller(self, df, sample):
+        '''
+            Пакетно проверяет спеллером все уникальные тексты датафрейма до построчной обработки,
+            чтобы спеллер вызывался по одному разу на текст минимальным числом запросов.
+            sample - пример входной строки, по нему определяются параметры поиска.
+        '''
+        if not hasattr(self.speller, 'prefetch') or len(df) == 0:
+            return
+        optional = get_optional_parametres(sample, self.levenshtein_threshold, self.speller)
+        self.speller.prefetch(get_speller_texts(df, self.match_columns, self.index, optional))
+
+
+    def speller_stats(self):
+        '''
+            Статистика кэша спеллера: hits, misses, evictions, size, bytes, hit_ratio.
+        '''
+        if not hasattr(self.speller, 'stats'):
+            return {}
+        return self.speller.stats()
+
+
+    def _log_speller_stats(self):
+        stats = self.speller_stats()
+        if stats:
+            logging.info(f"speller cache: hits {stats['hits']}, misses {stats['misses']}, hit ratio {stats['hit_ratio']:.2%}")
+
+    
+    def _process_frame(self, frame, items):
+        '''
+            Нормализует сразу все адреса датафрейма frame (столбцы - уровни адреса).
+            Точные совпадения по всем уровням ищутся по столбцам через merge с эталоном,
+            остальные строки (items - исходные входные данные по позициям) обрабатываются построчно
+            _process_address со спеллером и нечётким поиском.
+            Возвращает датафрейм с позиционным индексом.
+        '''
+        levels, empty, first, counts = search_direct_frame(frame, self.match_columns, self.index)
+        resolved = first >= 0
+        parts = []
+        if resolved.any():
+            part = direct_frame_result(self.standard, levels,
+                                       {key: mask[resolved] for key, mask in empty.items()},
+                                       first[resolved], counts[resolved])
+            part.index = np.flatnonzero(resolved)
+            parts.append(part)
+        if not resolved.all():
+            rest = np.flatnonzero(~resolved)
+            self._prefetch_speller(frame.iloc[rest], items(rest[0]))
+            # одинаковые сочетания уровней ищутся один раз
+            if levels:
+                codes = frame.iloc[rest].groupby(levels, sort=False, dropna=False).ngroup().to_numpy()
+            else:
+                codes = np.zeros(len(rest), dtype=np.int64)
+            _, unique_positions = np.unique(codes, return_index=True)
+            part = pd.DataFrame([self._process_address(items(rest[i])) for i in unique_positions]).iloc[codes]
+            part.index = rest
+            parts.append(part)
+        result = pd.concat(parts).sort_index()
+        # статусы в порядке уровней во входных данных
+        status_columns = [key + '_status' for key in levels if key + '_status' in result.columns]
+        status_columns.extend(sorted(set(result.columns) - set(self.standard.columns) - set(status_columns)))
+        return result.reindex(columns=self.standard.columns.tolist() + status_columns)
+
+
     def _process_df(self, df):
         '''
-            Функция запускает итерацию по dataframe.
-            Принимает на вход dataframe, запускает итерацию через apply.
+            Функция обрабатывает dataframe.
+            Точные совпадения ищутся сразу по всем строкам, остальные строки - построчно.
             Сортирует колонки полученного ответа и возвращает новый dataframe.
         '''
-        result = df.apply(self._process_address, axis=1, result_type="expand")
-        result_columns = result.columns.tolist()
-        standard_columns = self.standard.columns.tolist()
-        status_columns = list(set(result_columns) - set(standard_columns))
-        standard_columns.extend(status_columns)
-        result = result.reindex(columns=standard_columns)
+        if len(df) == 0:
+            return df.apply(self._process_address, axis=1, result_type="expand")
+        result = self._process_frame(df, lambda i: df.iloc[i])
+        result.index = df.index
+        self._log_speller_stats()
         return result
     
     
     def _process_series(self, df_series):
         '''
-            Функция запускает итерацию по pd.Series.
-            Принимает на вход pd.Series, запускает итерацию через apply.
+            Функция обрабатывает pd.Series.
+            Серия словарей обрабатывается как датафрейм, строки адресов - построчно через apply.
             Возвращает финальный результат.
         '''
-        return pd.DataFrame(df_series.apply(self._process_address).values.tolist())
+        if len(df_series) > 0 and all(isinstance(item, dict) for item in df_series):
+            items = df_series.tolist()
+            result = self._process_frame(pd.DataFrame(items), lambda i: items[i])
+            result.index = range(len(result))
+            self._log_speller_stats()
+            return result
+        if len(df_series) > 0 and hasattr(self.speller, 'prefetch') and self.speller.context:
+            # для строк спеллеру уходит вся адресная строка
+            self.speller.prefetch(df_series.unique().tolist())
+        result = pd.DataFrame(df_series.apply(self._process_address).values.tolist())
+        self._log_speller_stats()
+        return result
         
     
+    def normalize_parallel(self, data, n_workers=None, chunksize=10000):
+        '''
+            Нормализует pd.DataFrame или pd.Series в n_workers процессах кусками по chunksize строк,
+            порядок строк сохраняется. Процессы разделяют индексы эталона с родителем (fork, copy-on-write).
+            Тексты для спеллера проверяются заранее в родительском процессе, чтобы рабочие процессы
+            получили заполненный кэш.
+        '''
+        if isinstance(data, pd.DataFrame) and len(data) > 0:
+            self._prefetch_speller(data, data.iloc[0])
+        return normalize_parallel(self, data, n_workers, chunksize)
+
+    
     def __call__(self, input_data):
         if isinstance(input_data, pd.DataFrame):
             return self._process_df(input_data)
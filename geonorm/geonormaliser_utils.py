@@ -1,12 +1,14 @@
 import pathlib
 import numpy as np
 import pandas as pd
-from thefuzz import process
+from rapidfuzz import process, fuzz
+from thefuzz.utils import full_process
 import re
 import requests
-from sklearn.metrics import accuracy_score
 from .natasha_decompose import decompose
-from .text_utils import remove_descriptors
+from .text_utils import remove_descriptors, remove_descriptors_series, normalize_text, normalize_series
+from .speller import apply_hints
+from .array_utils import intersect_sorted
 import os
 import shutil
 from zipfile import ZipFile, ZIP_DEFLATED
@@ -86,6 +88,145 @@ def load_standard(standard_db=None, current_directory='./'):
     return standard.fillna('')
 
 
+class StandardIndex:
+    '''
+        Индексы эталона, строятся один раз при создании Geonormaliser.
+        Поиск работает с массивами номеров строк эталона, DataFrame не копируется.
+        columns - столбцы эталона в виде numpy-массивов;
+        positions - для каждого столбца поиска словарь значение -> отсортированные номера строк;
+        canonical - то же для канонических форм значений (normalize_text), по ним ищется,
+        если буквального совпадения нет. Канонические формы считаются один раз на уникальное значение.
+    '''
+    def __init__(self, standard, columns, fuzzy=False):
+        self.standard_columns = standard.columns.tolist()
+        self.columns = {column: standard[column].to_numpy(dtype=object) for column in self.standard_columns}
+        self.all_rows = np.arange(len(standard), dtype=np.int32)
+        self.positions = {
+            column: {value: rows.astype(np.int32) for value, rows in standard.groupby(column, sort=False).indices.items()}
+            for column in columns
+        }
+        self.values = {column: pd.Index(list(self.positions[column])) for column in columns}
+        canonical_columns = {column: normalize_series(column, standard[column]) for column in columns}
+        self.canonical = {
+            column: {value: rows.astype(np.int32) for value, rows in canonical_column.groupby(canonical_column, sort=False).indices.items() if value != ''}
+            for column, canonical_column in canonical_columns.items()
+        }
+        # столбцы поиска (буквальные и канонические) с номерами строк для точного поиска сразу по всему датафрейму
+        self.frame = standard[list(columns)].assign(
+            **{column + CANONICAL_SUFFIX: canonical_column.to_numpy() for column, canonical_column in canonical_columns.items()},
+            **{ROW_COLUMN: self.all_rows}
+        )
+        # кандидаты для нечёткого поиска, строятся только если он используется
+        self.fuzzy = FuzzyIndex(standard, columns, self.all_rows) if fuzzy else None
+
+    def lookup(self, key, level, rows):
+        '''
+            Номера строк из rows (отсортированного массива), у которых значение столбца key равно level.
+        '''
+        found = self.positions[key].get(level)
+        if found is None:
+            found = self.canonical[key].get(normalize_text(level, key))
+        if found is None:
+            return found_nothing
+        if len(rows) != len(self.all_rows):
+            found = intersect_sorted(rows, found)
+        return found
+
+    def record(self, row):
+        '''
+            Строка эталона в виде словаря.
+        '''
+        return {column: self.columns[column][row] for column in self.standard_columns}
+
+
+found_nothing = np.empty(0, dtype=np.int32)
+ROW_COLUMN = '__standard_row'
+CANONICAL_SUFFIX = '__canonical'
+
+
+def fuzzy_process(value):
+    '''
+        Та же предобработка строки, что в thefuzz.process.extractOne со скорером WRatio.
+    '''
+    return full_process(full_process(str(value)), force_ascii=True)
+
+
+class FuzzyIndex:
+    '''
+        Кандидаты для нечёткого поиска по расстоянию Левенштейна.
+        Для каждого столбца: коды значений по строкам эталона (в порядке первого появления)
+        и заранее обработанные уникальные значения, чтобы не пересчитывать unique() на каждый промах.
+        Для столбцов, где уникальных значений больше block_min, строится индекс символьных биграмм:
+        если кандидатов больше block_min, сравниваются только те, у которых общих с запросом биграмм
+        не меньше min_shared от числа биграмм более короткой из двух строк (так остаются и короткие значения,
+        целиком входящие в запрос, которые WRatio оценивает по partial_ratio).
+    '''
+    def __init__(self, standard, columns, all_rows, block_min=1000, min_shared=0.3):
+        self.all_rows = all_rows
+        self.block_min = block_min
+        self.min_shared = min_shared
+        self.codes = {}
+        self.uniques = {}
+        self.choices = {}
+        self.bigrams = {}
+        self.bigram_counts = {}
+        for column in columns:
+            codes, uniques = pd.factorize(standard[column], sort=False)
+            self.codes[column] = codes.astype(np.int32)
+            self.uniques[column] = np.asarray(uniques, dtype=object)
+            self.choices[column] = np.array([fuzzy_process(value) for value in uniques], dtype=object)
+            if len(uniques) > block_min:
+                self.bigrams[column] = self.build_bigrams(self.choices[column])
+                self.bigram_counts[column] = np.array([len(get_bigrams(choice)) for choice in self.choices[column]],
+                                                      dtype=np.int32)
+
+    @staticmethod
+    def build_bigrams(choices):
+        bigrams = {}
+        for code, choice in enumerate(choices):
+            for bigram in get_bigrams(choice):
+                bigrams.setdefault(bigram, []).append(code)
+        return {bigram: np.array(codes, dtype=np.int32) for bigram, codes in bigrams.items()}
+
+    def candidates(self, key, query, rows):
+        '''
+            Коды уникальных значений столбца key в строках rows, в порядке появления в эталоне.
+        '''
+        if len(rows) == len(self.all_rows):
+            codes = np.arange(len(self.uniques[key]), dtype=np.int32)
+        else:
+            codes = pd.unique(self.codes[key][rows])
+        if len(codes) > self.block_min and key in self.bigrams:
+            bigrams = get_bigrams(query)
+            found = [self.bigrams[key][bigram] for bigram in bigrams if bigram in self.bigrams[key]]
+            if found:
+                # число общих с запросом биграмм у каждого кандидата
+                shared = np.bincount(np.concatenate(found), minlength=len(self.uniques[key]))[codes]
+                mask = shared >= np.maximum(1, np.ceil(self.min_shared * np.minimum(len(bigrams), self.bigram_counts[key][codes])))
+                if mask.any():
+                    codes = codes[mask]
+        return codes
+
+    def extract(self, key, level, rows, score_cutoff=0):
+        '''
+            Ближайшее к level значение столбца key среди строк rows и его похожесть (WRatio, 0-100).
+            Кандидаты с похожестью ниже score_cutoff отбрасываются сразу; если таких нет, возвращается (None, 0).
+        '''
+        query = fuzzy_process(level)
+        codes = self.candidates(key, query, rows)
+        # похожесть округляется до целого, поэтому порог сдвинут на 0.5
+        result = process.extractOne(query, self.choices[key][codes], scorer=fuzz.WRatio,
+                                    processor=None, score_cutoff=max(score_cutoff - 0.5, 0))
+        if result is None:
+            return None, 0
+        _, score, position = result
+        return self.uniques[key][codes[position]], int(round(score))
+
+
+def get_bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
 def get_address_by_level(input_data, match_columns):
     if isinstance(input_data, pd.Series):
         address_by_level = {}
@@ -106,6 +247,81 @@ def get_address_by_level(input_data, match_columns):
     return address_by_level
 
 
+def search_direct_frame(df, match_columns, index):
+    '''
+        Точный поиск сразу для всех строк датафрейма df, столбцы которого - уровни адреса.
+        Строки группируются по набору пустых уровней и уровней, найденных только по канонической форме,
+        для каждой группы уникальные сочетания значений соединяются (merge) с эталоном по непустым уровням.
+        Возвращает уровни в порядке столбцов df, маски пустых значений по уровням,
+        номер первой подходящей строки эталона для каждой строки df и число подходящих строк.
+        Номер -1 - строку нужно искать построчно (спеллер, нечёткий поиск): значение уровня
+        не найдено в эталоне, сочетание уровней не встречается или значение не строка.
+    '''
+    levels = [key for key in df.columns if key in match_columns]
+    first = np.full(len(df), -1, dtype=np.int64)
+    counts = np.zeros(len(df), dtype=np.int64)
+    resolvable = np.ones(len(df), dtype=bool)
+    values = {}
+    empty = {}
+    canonical = {}
+    for key in levels:
+        column = df[key].to_numpy(dtype=object)
+        is_str = np.fromiter((isinstance(level, str) for level in column), dtype=bool, count=len(column))
+        is_none = np.fromiter((level is None for level in column), dtype=bool, count=len(column))
+        resolvable &= is_str | is_none
+        column = pd.Series(np.where(is_str, column, ''), dtype=object)
+        # как в direct: кавычки убираются
+        quoted = column.str.contains('"', regex=False).to_numpy()
+        if quoted.any():
+            column[quoted] = column[quoted].str.replace('"', '', regex=False).str.strip()
+        empty[key] = is_none | (is_str & (df[key].to_numpy(dtype=object) == ''))
+        # как в lookup: значения, которых нет в эталоне буквально, ищутся по канонической форме
+        canonical[key] = is_str & ~empty[key] & ~column.isin(index.values[key]).to_numpy()
+        if canonical[key].any():
+            column[canonical[key]] = normalize_series(key, column[canonical[key]])
+            resolvable &= ~(canonical[key] & (column == '').to_numpy())
+        values[key] = column
+    values = pd.DataFrame(values, columns=levels)
+
+    pattern = np.zeros(len(df), dtype=np.int64)
+    for i, key in enumerate(levels):
+        pattern |= empty[key].astype(np.int64) << 2 * i
+        pattern |= canonical[key].astype(np.int64) << 2 * i + 1
+    for code in np.unique(pattern[resolvable]):
+        selected = np.flatnonzero(resolvable & (pattern == code))
+        columns = [key for i, key in enumerate(levels) if not code >> 2 * i & 1]
+        if not columns:
+            first[selected] = 0
+            counts[selected] = len(index.all_rows)
+            continue
+        keys = [key + CANONICAL_SUFFIX if code >> 2 * levels.index(key) + 1 & 1 else key for key in columns]
+        combinations = values.iloc[selected][columns].set_axis(keys, axis=1)
+        found = (combinations.drop_duplicates()
+                             .merge(index.frame[keys + [ROW_COLUMN]], on=keys, how='inner')
+                             .groupby(keys, sort=False)[ROW_COLUMN].agg(['min', 'size']))
+        matched = combinations.merge(found, left_on=keys, right_index=True, how='left')
+        matched_first = matched['min'].to_numpy()
+        hit = ~np.isnan(matched_first)
+        first[selected[hit]] = matched_first[hit]
+        counts[selected[hit]] = matched['size'].to_numpy()[hit]
+    return levels, empty, first, counts
+
+
+def direct_frame_result(standard, levels, empty, first, counts):
+    '''
+        Ответ для строк, найденных search_direct_frame, в той же форме, что valid_result:
+        первая подходящая строка эталона и статусы 'empty' / 'direct' по уровням,
+        у последнего уровня - 'duplicates', если подходящих строк несколько.
+    '''
+    result = standard.iloc[first].reset_index(drop=True).astype(object)
+    for key in levels:
+        status = np.where(empty[key], 'empty', 'direct').astype(object)
+        if key == levels[-1]:
+            status[counts > 1] = 'duplicates'
+        result[key + '_status'] = pd.Series(status, dtype=object)
+    return result
+
+
 def get_pull_methods(use_speller, use_levenstein):
     pull_methods = [preprocessor, direct_method, speller_direct_method, speller_levenstein_direct_method]
     if not use_levenstein:
@@ -115,9 +331,10 @@ def get_pull_methods(use_speller, use_levenstein):
     return pull_methods
 
 
-def get_optional_parametres(input_data, levenshtein_threshold):
+def get_optional_parametres(input_data, levenshtein_threshold, speller=None):
     optional = {}
     optional['levenshtein_threshold'] = levenshtein_threshold
+    optional['speller'] = speller
     if isinstance(input_data, str):
         optional['row_for_speller'] = input_data
     if isinstance(input_data, pd.Series):
@@ -125,16 +342,19 @@ def get_optional_parametres(input_data, levenshtein_threshold):
     return optional
 
 
-def valid_result(address_normalize, address_normalize_status, standard):
-    if len(address_normalize) == 1:
-        result = dict(address_normalize.to_dict('records')[0], **address_normalize_status)
-    elif len(address_normalize) > 1:
+def valid_result(rows, address_normalize_status, index):
+    '''
+        Собирает ответ: первая из найденных строк эталона и статусы поиска по уровням.
+    '''
+    if len(rows) == 1:
+        result = dict(index.record(rows[0]), **address_normalize_status)
+    elif len(rows) > 1:
         last_level_status = list(address_normalize_status.keys())[-1]
         if last_level_status != 'empty':
             address_normalize_status[last_level_status] = 'duplicates'
-        result = dict(address_normalize.to_dict('records')[0], **address_normalize_status)
+        result = dict(index.record(rows[0]), **address_normalize_status)
     else:
-        result = dict({i: '' for i in standard.columns}, **address_normalize_status)
+        result = dict({i: '' for i in index.standard_columns}, **address_normalize_status)
     return result
 
 
@@ -143,51 +363,54 @@ def valid_result(address_normalize, address_normalize_status, standard):
     Функции методов
 '''
 
-def direct(key, level, standard):
-    try:
-        result = standard.query(f'{key} == "{level}"')
-    except:
-        level_correct = re.sub('"', '', level).strip()
-        result = standard.query(f'{key} == "{level_correct}"')
-    finally:
-        return result
+def direct(key, level, rows, index):
+    if isinstance(level, str) and '"' in level:
+        level = re.sub('"', '', level).strip()
+    return index.lookup(key, level, rows)
 
 
-def speller(level, optional=None):
-    warning_limit_text = 'Закончился лимит подключения, используется оригинальная строка'
-    url = 'https://speller.yandex.net/services/spellservice.json/checkText?text={}'
-    if 'row_for_speller' in optional:
-        row = optional['row_for_speller']
-        level_split = re.split('-| ', level)
-        try:
-            speller_response = requests.get(url.format(row)).json()
-            for word in level_split:
-                for hint in speller_response:
-                    if word == hint['word']:
-                        level = re.sub(word, hint['s'][0], level)
-        except:
-            print(warning_limit_text)
-        finally:
-            return level
+def get_speller_text(level, optional):
+    '''
+        Текст, который отправляется спеллеру для level.
+        Спеллеру с контекстом (Яндекс) отправляется вся строка адреса или level + ', улица'.
+    '''
+    if not getattr(optional['speller'], 'context', True):
+        return level
+    elif 'row_for_speller' in optional:
+        return optional['row_for_speller']
     else:
-        substring = level + ', улица'
-        level_split = re.split('-| ', level)
-        try:
-            speller_response = requests.get(url.format(substring)).json()
-            for word in level_split:
-                for hint in speller_response:
-                    if word == hint['word']:
-                        level = re.sub(word, hint['s'][0], level)
-        except:
-            print(warning_limit_text)
-        finally:
-            return level
+        return level + ', улица'
+
+
+def speller(level, optional=None):
+    '''
+        Исправляет опечатки в level спеллером optional['speller'] (см. geonorm.speller).
+    '''
+    return apply_hints(level, optional['speller'].check(get_speller_text(level, optional)))
+
+
+def get_speller_texts(df, match_columns, index, optional):
+    '''
+        Все уникальные тексты, которые могут уйти спеллеру при обработке датафрейма df:
+        значения уровней, которых нет в эталоне, подготовленные так же, как в методах поиска.
+    '''
+    texts = set()
+    for key in match_columns:
+        if key not in df.columns:
+            continue
+        levels = pd.Series([
+            level for level in df[key].unique()
+            if isinstance(level, str) and level != '' and level not in index.positions[key]
+            and normalize_text(level, key) not in index.canonical[key]
+        ], dtype=object)
+        if 'use_remove_descriptors' in optional:
+            levels = remove_descriptors_series(key, levels)
+        texts.update(get_speller_text(level, optional) for level in levels)
+    return list(texts)
 
 
-def levenstein(key, level, standard):
-    level_list = standard[key].unique()
-    level_levenstein_variant, rate = process.extractOne(level, level_list)
-    return level_levenstein_variant, rate
+def levenstein(key, level, rows, index, levenshtein_threshold=0):
+    return index.fuzzy.extract(key, level, rows, levenshtein_threshold)
 
 
 
@@ -195,69 +418,71 @@ def levenstein(key, level, standard):
     Методы поиска
 '''
 
-def preprocessor(key, level, standard, optional=None):
+def preprocessor(key, level, rows, index, optional=None):
     if level == '' or level == np.nan or level == None:
         status = 'empty'
     else:
         status = 'check_empty_passed'
-    return standard, status
+    return rows, status
 
 
-def direct_method(key, level, standard, optional=None):
-    result = direct(key, level, standard)
-    if result.shape[0] == 0:
+def direct_method(key, level, rows, index, optional=None):
+    result = direct(key, level, rows, index)
+    if len(result) == 0:
         status = 'not_found'
-        return standard, status
+        return rows, status
     else:
         status = 'direct'
         return result, status
 
     
-def speller_direct_method(key, level, standard, optional=None):
+def speller_direct_method(key, level, rows, index, optional=None):
     if 'use_remove_descriptors' in optional:
         level = remove_descriptors(key, level)
     level_name_speller = speller(level, optional)
-    result = direct(key, level_name_speller, standard)
-    if result.shape[0] == 0:
+    result = direct(key, level_name_speller, rows, index)
+    if len(result) == 0:
         status = 'not_found'
-        return standard, status
+        return rows, status
     else:
         status = 'speller'
         return result, status
 
     
-def speller_levenstein_direct_method(key, level, standard, optional=None):
+def speller_levenstein_direct_method(key, level, rows, index, optional=None):
     levenshtein_threshold = optional['levenshtein_threshold']
     if 'use_remove_descriptors' in optional:
         level = remove_descriptors(key, level)
     level_name_speller = speller(level, optional)
-    level_name_levenstein, rate = levenstein(key, level_name_speller, standard)
+    level_name_levenstein, rate = levenstein(key, level_name_speller, rows, index, levenshtein_threshold)
     if rate >= levenshtein_threshold:
-        result = direct(key, level_name_levenstein, standard)
+        result = direct(key, level_name_levenstein, rows, index)
         status = rate
         return result, status
     else:
         status = 'threshold'
-        return standard, status
+        return rows, status
 
 
 
-def search_reference_address(address_by_level, standard, pull_methods, optional):
+def search_reference_address(address_by_level, index, pull_methods, optional):
     '''
         Функция ищет эталон по уровням входящего адреса.
-        Принимает dict, возвращает срез эталона и словарь со статусами.
+        Принимает dict, возвращает номера подходящих строк эталона и словарь со статусами.
+        Каждый уровень сужает отсортированный массив номеров строк, начиная со всего эталона.
     '''
+    rows = index.all_rows
     address_by_level_status = {}
     for key, level in address_by_level.items():
         for method in pull_methods:
-            result, status = method(key, level, standard, optional)
+            result, status = method(key, level, rows, index, optional)
             if status in ['not_found','check_empty_passed']:
                 continue
             else:
                 address_by_level_status[key + '_status'] = status
-                standard = result
+                rows = result
                 break
-    return result, address_by_level_status
+    return rows, address_by_level_status
   
 
 
@@ -269,6 +494,8 @@ def _measure_quality(X, y, difference=False, columns=False):
         Для difference = True доп-о возвращает не совпавшие строки методом pd.compare().
         В колонке valid содержимое y, в колонке actual — X.
     '''
+    # sklearn импортируется здесь, а не при импорте модуля: он нужен только для оценки качества
+    from sklearn.metrics import accuracy_score
     assert X.shape[0] == y.shape[0], 'Количество объектов в датафреймах различается'
     if not columns:
         columns = y.columns
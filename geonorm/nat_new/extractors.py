@@ -1,5 +1,45 @@
+import pickle
 from natasha.obj import Obj
-from natasha.extractors import Extractor, Match
+from natasha.extractors import Extractor, Match, Parser
+from yargy.interpretation.fact import Fact
+
+
+FACT_MODULE = Fact.__module__
+
+
+class RuleDumper(pickle.Pickler):
+    '''
+        Классы фактов, созданные yargy.fact() и перекрытые в грамматике подклассами с тем же именем,
+        не импортируются по имени, поэтому сохраняются ссылкой ('fact', имя).
+    '''
+    def persistent_id(self, obj):
+        if isinstance(obj, type) and issubclass(obj, Fact) and obj is not Fact and obj.__module__ == FACT_MODULE:
+            return ('fact', obj.__name__)
+        return None
+
+
+class RuleLoader(pickle.Unpickler):
+    def persistent_load(self, pid):
+        from .grammars import addrConfig
+        kind, name = pid
+        # базовый факт - родитель одноимённого класса грамматики
+        for base in getattr(addrConfig, name).__bases__:
+            if base.__name__ == name and base.__module__ == FACT_MODULE:
+                return base
+        raise pickle.UnpicklingError(f'unknown fact {name}')
+
+
+class CompiledParser(Parser):
+    '''
+        Парсер natasha из уже скомпилированного правила: грамматика не строится и не активируется заново.
+    '''
+    def __init__(self, rule, morph):
+        from yargy.morph import MorphAnalyzer
+        from yargy.tokenizer import MorphTokenizer
+        from yargy.tagger import PassTagger
+        self.tokenizer = MorphTokenizer(morph=MorphAnalyzer(morph))
+        self.tagger = PassTagger()
+        self.rule = rule
 
 
 class AddrExtractorConfig(Extractor):
@@ -10,6 +50,23 @@ class AddrExtractorConfig(Extractor):
 
         Extractor.__init__(self, addr_parts, morph)
 
+    @classmethod
+    def from_rule(cls, morph, rule):
+        extractor = cls.__new__(cls)
+        extractor.parser = CompiledParser(rule, morph)
+        return extractor
+
+    def dump_rule(self, fp):
+        '''
+            Сохраняет скомпилированное правило парсера (грамматику с активированными предикатами
+            и словарями pipeline) в файловый объект fp. Морфологический словарь не сохраняется.
+        '''
+        RuleDumper(fp, protocol=pickle.HIGHEST_PROTOCOL).dump(self.parser.rule)
+
+    @classmethod
+    def load_rule(cls, morph, fp):
+        return cls.from_rule(morph, RuleLoader(fp).load())
+
     def find(self, text):
         matches = list(self(text))
         if not matches:
@@ -1,86 +1,351 @@
-from natasha import (
-    MorphVocab,
-)
-
-from .nat_new.extractors import (
-    AddrExtractorConfig
-)
-
+import os
+import re
 import json
-from yargy.tokenizer import MorphTokenizer
+import hashlib
+import logging
+import threading
+from collections import Counter, namedtuple
+from functools import partial
+import pandas as pd
+from .parallel import map_parallel
 
 # добавлено чтобы корректно отрабатывала подгрузка конфига из директории с библиотекой
 import pathlib
 
 CURRENT_DIRECTORY = str(pathlib.Path(__file__).parent.resolve())
 
-tokenizer = MorphTokenizer()
+# директория кэша скомпилированной грамматики экстрактора; пустая строка в GEONORM_CACHE_DIR отключает кэш
+GRAMMAR_CACHE_DIR = os.environ.get('GEONORM_CACHE_DIR', str(pathlib.Path.home() / '.cache' / 'geonorm'))
 
-# todo: сделать единый класс с конфигами для библиотеки
-with open(pathlib.Path(f'{CURRENT_DIRECTORY}/config.json'), 'r', encoding="utf-8") as fp:
-    config = json.loads(fp.read().lower())
 
+'''
+    Конфиг, токенизатор, морфологический словарь и экстрактор адресов тяжёлые (natasha, pymorphy,
+    компиляция грамматики yargy), поэтому создаются один раз при первом использовании, а не при импорте.
+    warm_up() создаёт всё заранее, например, перед запуском рабочих процессов.
+'''
+_lock = threading.RLock()
+_instances = {}
+
+
+def _get_instance(name, build):
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = build()
+                _instances[name] = instance
+    return instance
+
+
+def _build_config():
+    # todo: сделать единый класс с конфигами для библиотеки
+    with open(pathlib.Path(f'{CURRENT_DIRECTORY}/config.json'), 'r', encoding="utf-8") as fp:
+        return json.loads(fp.read().lower())
+
+
+def _build_tokenizer():
+    from yargy.tokenizer import MorphTokenizer
+    return MorphTokenizer()
+
+
+def _build_morph_vocab():
+    from natasha import MorphVocab
+    return MorphVocab()
+
+
+def get_grammar_cache_path(cache_dir=None):
+    '''
+        Файл кэша скомпилированной грамматики. Ключ - хэш config.json, исходника грамматики
+        и версии yargy, так что при изменении любого из них грамматика строится заново.
+    '''
+    from importlib.metadata import version
+    digest = hashlib.sha256()
+    for path in ('config.json', 'nat_new/grammars/addrConfig.py'):
+        digest.update(pathlib.Path(f'{CURRENT_DIRECTORY}/{path}').read_bytes())
+    digest.update(version('yargy').encode())
+    return pathlib.Path(cache_dir or GRAMMAR_CACHE_DIR) / f'addr_grammar_{digest.hexdigest()[:16]}.pickle'
 
-def prepare_address(item):
-    house_title = [' д.', ',д.', ' д', ',д', ' Д', ',Д']
-    digits = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
 
-    for house_item in house_title:
-        if house_item in item and 'дом' not in item:
+def save_grammar_cache(extractor, path):
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, 'wb') as fp:
+            extractor.dump_rule(fp)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logging.info(f'grammar cache is not saved to {path}: {e!r}')
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def _build_address_extractor():
+    from .nat_new.extractors import AddrExtractorConfig
+    morph_vocab = get_morph_vocab()
+    if not GRAMMAR_CACHE_DIR:
+        return AddrExtractorConfig(morph_vocab, get_config()['extractor_rule'])
+
+    path = get_grammar_cache_path()
+    try:
+        with open(path, 'rb') as fp:
+            return AddrExtractorConfig.load_rule(morph_vocab, fp)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning(f'grammar cache {path} is not loaded, rebuilding: {e!r}')
+
+    extractor = AddrExtractorConfig(morph_vocab, get_config()['extractor_rule'])
+    save_grammar_cache(extractor, path)
+    return extractor
+
+
+def get_config():
+    return _get_instance('config', _build_config)
+
+
+def get_tokenizer():
+    return _get_instance('tokenizer', _build_tokenizer)
+
+
+def get_morph_vocab():
+    return _get_instance('morph_vocab', _build_morph_vocab)
+
+
+def get_address_extractor():
+    return _get_instance('address_extractor', _build_address_extractor)
+
+
+def warm_up():
+    '''
+        Создаёт конфиг, токенизатор, морфологический словарь, экстрактор адресов и таблицы правил заранее.
+    '''
+    get_config()
+    get_tokenizer()
+    get_address_extractor()
+    get_address_rules()
+    get_segment_rules()
+
+
+_lazy_attributes = {
+    'config': get_config,
+    'tokenizer': get_tokenizer,
+    'morph_vocab': get_morph_vocab,
+    'address_extractor': get_address_extractor,
+}
+
+
+def __getattr__(name):
+    # для совместимости: natasha_decompose.config, .tokenizer, .morph_vocab, .address_extractor
+    if name in _lazy_attributes:
+        return _lazy_attributes[name]()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def before_first(marker):
+    # текст до первого вхождения marker: символы, кроме первого символа marker, и этот символ, если с него
+    # не начинается marker
+    first = re.escape(marker[0])
+    rest = f'(?!{re.escape(marker[1:])})' if len(marker) > 1 else '(?!)'
+    return f'[^{first}]*(?:{first}{rest}[^{first}]*)*'
+
+
+def compile_address_rules(rules):
+    '''
+        Готовит таблицу правил подготовки адреса (address_rules из descriptors_config.json):
+        house_markers - маркеры дома: первое вхождение маркера, за которым через пробелы и точки идёт цифра,
+            заменяется на house_replacement; маркеры проверяются по порядку, строки с house_exclude не меняются;
+        suffix_rules - маркер заменяется везде, если его первое вхождение находится ближе position_from_end
+            символов к концу строки и в строке нет exclude;
+        replacements - замены подстрок, применяются по порядку.
+        Для pd.Series условия house_markers и suffix_rules собираются в регулярные выражения.
+    '''
+    exclude = re.escape(rules['house_exclude'])
+    house_patterns = [
+        re.compile(f'(?s)^(?!.*{exclude})({before_first(marker)}){re.escape(marker)}(?=[ .]*[0-9])')
+        for marker in rules['house_markers']
+    ]
+
+    suffix = []
+    for rule in rules['suffix_rules']:
+        for marker in rule['markers']:
+            tail = rule['position_from_end'] - 1 - len(marker)
+            if tail < 0:
+                # маркер не помещается в заданный хвост строки
+                continue
+            rule_exclude = f'(?!.*{re.escape(rule["exclude"])})' if rule.get('exclude') else ''
+            # первое вхождение в хвосте строки - ни за одним вхождением нет больше tail символов
+            pattern = re.compile(f'(?s)^{rule_exclude}(?=.*{re.escape(marker)})(?!.*{re.escape(marker)}.{{{tail + 1}}})')
+            suffix.append((marker, rule.get('exclude'), rule['position_from_end'], rule['replacement'], pattern))
 
-            ind0 = item.index(house_item)
-            i = ind0 + len(house_item)
-            is_next_number = False
-            while len(item) > i and not is_next_number:
+    return {
+        'house_markers': rules['house_markers'],
+        'house_exclude': rules['house_exclude'],
+        'house_replacement': rules['house_replacement'],
+        'house_number': re.compile('[ .]*[0-9]'),
+        'house_patterns': house_patterns,
+        'suffix': suffix,
+        'replacements': [tuple(replacement) for replacement in rules['replacements']]
+    }
 
-                if item[i] != ' ' and item[i] != '.':
 
-                    if item[i] in digits:
-                        is_next_number = True
-                        break
-                    else:
-                        break
-                i += 1
+def _build_address_rules():
+    with open(pathlib.Path(f'{CURRENT_DIRECTORY}/descriptors_config.json'), 'r', encoding='utf-8') as fp:
+        return compile_address_rules(json.load(fp)['address_rules'])
 
-            if is_next_number:
-                item = item[:ind0] + " дом " + item[ind0 + len(house_item):]
+
+def get_address_rules():
+    return _get_instance('address_rules', _build_address_rules)
+
+
+def prepare_address(item):
+    '''
+        Подготовка адресной строки перед разбором: маркеры дома, корпуса, домов без номера
+        и сокращения типов приводятся к виду, который понимает грамматика (правила - get_address_rules).
+    '''
+    rules = get_address_rules()
+    if rules['house_exclude'] not in item:
+        house_number = rules['house_number']
+        for marker in rules['house_markers']:
+            position = item.find(marker)
+            if position >= 0 and house_number.match(item, position + len(marker)):
+                item = item[:position] + rules['house_replacement'] + item[position + len(marker):]
                 break
 
-    house_item = "корп"
-    if 'корпус' not in item and house_item in item and item.index(house_item) > len(item) - 15:
-        item = item.replace(house_item, ' корп ')
-
-    house_items = ["р-н", 'район м.район.']
-    for house_item in house_items:
-        item = item.replace(house_item, 'район')
-
-    house_no_num = ['б/н', 'Б/Н', ' бн ', 'б\\н', 'б/Н']
-    for house_item in house_no_num:
-        if house_item in item and item.index(house_item) > len(item) - 4:
-            item = item.replace(house_item, ' 100001')
-
-    item = item.replace(' и(при) ', ' ')
-    item = item.replace('станция(и)', 'станция')
-    item = item.replace('с н.п.', 'село')
-    item = item.replace('г г.п.', 'г.')
-    item = item.replace('пгт н.п.', 'пгт')
-    item = item.replace('с/с', 'сельсовет')
-    item = item.replace(' рп ', ' рабочий поселок ')
-    item = item.replace(' ст ', ' станция ')
-    item = item.replace(' здание ', ' дом ')
-    item = item.replace(' тер ', ' территория ')
-    item = item.replace(' тер. ', ' территория ')
-    item = item.replace(' нп ', ' поселок ')
-    item = item.replace(' нп. ', ' поселок ')
-    item = item.replace(' посёлок ', ' поселок ')
-    item = item.replace('район улицы', ' улица ')
-    item = item.replace('район здания', ' здание ')
+    for marker, exclude, position_from_end, replacement, _ in rules['suffix']:
+        position = item.find(marker)
+        if position >= 0 and position > len(item) - position_from_end and not (exclude and exclude in item):
+            item = item.replace(marker, replacement)
 
+    for source, replacement in rules['replacements']:
+        item = item.replace(source, replacement)
     return item
 
 
+def prepare_address_series(series):
+    '''
+        prepare_address для pd.Series: каждое правило применяется к столбцу целиком через .str.
+    '''
+    rules = get_address_rules()
+    series = series.astype(object)
+    # после замены в строке появляется house_exclude, поэтому следующие маркеры её уже не меняют
+    # регулярные выражения применяются только к строкам, где есть маркер
+    for marker, pattern in zip(rules['house_markers'], rules['house_patterns']):
+        mask = series.str.contains(marker, regex=False).fillna(False).astype(bool)
+        if mask.any():
+            series = series.copy()
+            series[mask] = series[mask].str.replace(pattern, '\\g<1>' + rules['house_replacement'], n=1, regex=True)
+
+    for marker, _, _, replacement, pattern in rules['suffix']:
+        mask = series.str.contains(marker, regex=False).fillna(False).astype(bool)
+        mask[mask] = series[mask].str.match(pattern.pattern).astype(bool)
+        if mask.any():
+            series = series.copy()
+            series[mask] = series[mask].str.replace(marker, replacement, regex=False)
+
+    for source, replacement in rules['replacements']:
+        series = series.str.replace(source, replacement, regex=False)
+    return series
+
+
+# разметка быстрого разбора в том же виде, что и у экстрактора: match.start, match.stop, match.fact.type, match.fact.value
+SegmentMatch = namedtuple('SegmentMatch', ['start', 'stop', 'fact'])
+SegmentFact = namedtuple('SegmentFact', ['type', 'value'])
+
+NAME_WORD = '[А-ЯЁ][а-яё]+(?:-[А-ЯЁа-яё][а-яё]+)*'
+
+
+def compile_segment_rules(segments, rule):
+    '''
+        Готовит правила быстрого разбора (address_segments из descriptors_config.json):
+        prefix и suffix - сокращения и названия типов перед и после названия и тип, который для них
+        возвращает экстрактор; берутся только типы из config['rule'].
+        Название - от одного до трёх слов с заглавной буквы, номер дома - цифры и, возможно, буква.
+    '''
+    types = {value for field in rule for value in rule[field]}
+    prefix = {form: value for form, value in segments['prefix'].items() if value in types}
+    suffix = {form: value for form, value in segments['suffix'].items() if value in types}
+    return {
+        'prefix': prefix,
+        'suffix': suffix,
+        'max_words': max(len(form.split(' ')) for form in list(prefix) + list(suffix)),
+        'name': re.compile(f'{NAME_WORD}(?: {NAME_WORD}){{0,2}}\\Z'),
+        'house': re.compile(f'{re.escape(segments["house"])} +([0-9]+[а-яА-ЯёЁ]?)\\Z'),
+        'house_type': segments['house']
+    }
+
+
+def _build_segment_rules():
+    with open(pathlib.Path(f'{CURRENT_DIRECTORY}/descriptors_config.json'), 'r', encoding='utf-8') as fp:
+        return compile_segment_rules(json.load(fp)['address_segments'], get_config()['rule'])
+
+
+def get_segment_rules():
+    return _get_instance('segment_rules', _build_segment_rules)
+
+
+def classify_segment(text, rules):
+    match = rules['house'].match(text)
+    if match:
+        return SegmentFact(rules['house_type'], match.group(1))
+    words = text.split(' ')
+    for n in range(min(rules['max_words'], len(words) - 1), 0, -1):
+        descriptor = ' '.join(words[:n]).lower()
+        name = ' '.join(words[n:])
+        if descriptor in rules['prefix'] and rules['name'].match(name):
+            return SegmentFact(rules['prefix'][descriptor], name)
+        descriptor = ' '.join(words[-n:]).lower()
+        name = ' '.join(words[:-n])
+        if descriptor in rules['suffix'] and rules['name'].match(name):
+            return SegmentFact(rules['suffix'][descriptor], name)
+    return None
+
+
+def split_segments(item):
+    '''
+        Быстрый разбор подготовленной адресной строки без экстрактора: каждый сегмент между запятыми
+        должен быть "<тип> <название>", "<название> <тип>" или "дом <номер>".
+        Возвращает разметку сегментов или None, если хотя бы один сегмент не распознан.
+    '''
+    rules = get_segment_rules()
+    markup = []
+    start = 0
+    for segment in item.split(','):
+        text = segment.strip()
+        if text:
+            fact = classify_segment(text, rules)
+            if fact is None:
+                return None
+            begin = start + len(segment) - len(segment.lstrip())
+            markup.append(SegmentMatch(begin, begin + len(text), fact))
+        start += len(segment) + 1
+    return markup
+
+
+# сколько строк разобрано быстрым разбором ('fast') и экстрактором ('extractor'),
+# в том числе в рабочих процессах decompose_batch
+decompose_stats = Counter()
+
+
+def get_decompose_stats():
+    with _lock:
+        stats = dict(decompose_stats)
+    total = sum(stats.values())
+    for path in ('fast', 'extractor'):
+        stats.setdefault(path, 0)
+        stats[f'{path}_ratio'] = stats[path] / total if total else 0
+    return stats
+
+
+def reset_decompose_stats():
+    with _lock:
+        decompose_stats.clear()
+
+
 # костыль для городов федерального значения
 def federal_city_fix(data, clear_settlement=True):
+    config = get_config()
     if ('settlement' in data and
             data['settlement'].lower() in config['federal_city']):
         data['region'] = data["settlement"]
@@ -93,9 +358,25 @@ def federal_city_fix(data, clear_settlement=True):
     return data
 
 
-def decompose(item, hide_empty=False):
+def decompose(item, hide_empty=False, fast_path=True):
+    '''
+        Разбор адресной строки на уровни. При fast_path=True строки из сегментов известного вида
+        разбираются split_segments, остальные - экстрактором.
+    '''
+    obj, path = _decompose(item, hide_empty, fast_path)
+    with _lock:
+        decompose_stats[path] += 1
+    return obj
+
+
+def _decompose(item, hide_empty=False, fast_path=True):
+    config = get_config()
     item = prepare_address(item)
-    markup = list(address_extractor(item))
+    markup = split_segments(item) if fast_path else None
+    path = 'fast'
+    if markup is None:
+        markup = list(get_address_extractor()(item))
+        path = 'extractor'
 
     house = ''
     obj = {}
@@ -156,13 +437,42 @@ def decompose(item, hide_empty=False):
 
     obj['not_decompose'] = not_decompose.replace(',', '').strip()
 
-    return obj
+    return obj, path
+
+
+def decompose_batch(items, n_workers=1, chunksize=1000, hide_empty=False, fast_path=True):
+    '''
+        Декомпозиция набора адресных строк.
+        Одинаковые строки разбираются один раз; различные строки при n_workers > 1 разбираются
+        в пуле процессов кусками по chunksize (n_workers=None - по числу ядер).
+        Возвращает датафрейм с полями decompose по столбцам, строки в исходном порядке;
+        если items - pd.Series, индекс сохраняется. Пропуски (None, NaN) разбираются как пустая строка.
+        Доля строк, разобранных быстрым разбором, пишется в лог и добавляется в decompose_stats.
+    '''
+    index = items.index if isinstance(items, pd.Series) else None
+    items = pd.Series(list(items), dtype=object)
+    codes, uniques = pd.factorize(items.where(items.notna(), ''))
+    # экстрактор строится до запуска процессов, чтобы они получили его готовым
+    warm_up()
+    results = map_parallel(partial(_decompose, hide_empty=hide_empty, fast_path=fast_path),
+                           uniques.tolist(), n_workers, chunksize, initializer=warm_up)
+    paths = Counter(path for _, path in results)
+    with _lock:
+        decompose_stats.update(paths)
+    if results:
+        logging.info(f'decompose: fast path {paths["fast"]} of {len(results)} unique addresses '
+                     f'({paths["fast"] / len(results):.1%}), extractor {paths["extractor"]}')
+    result = pd.DataFrame([obj for obj, _ in results]).fillna('')
+    result = result.iloc[codes].reset_index(drop=True)
+    if index is not None:
+        result.index = index
+    return result
 
 
 def get_tokens(from_string):
     # sign_words = ['район','город','село','деревня']
     sign_words = ['село', 'деревня']
-    tokens = list(tokenizer(from_string))
+    tokens = list(get_tokenizer()(from_string))
 
     is_prts = False
 
@@ -188,6 +498,3 @@ def get_tokens(from_string):
 
     return tmp_tokens
 
-
-morph_vocab = MorphVocab()
-address_extractor = AddrExtractorConfig(morph_vocab, config['extractor_rule'])
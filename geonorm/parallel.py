@@ -0,0 +1,81 @@
+import os
+import multiprocessing
+import pandas as pd
+
+
+# матчер рабочих процессов: при fork наследуется от родителя без копирования (copy-on-write),
+# иначе передаётся один раз на процесс через initializer
+_matcher = None
+
+
+def _init_worker(matcher):
+    global _matcher
+    _matcher = matcher
+
+
+def _process_chunk(chunk):
+    return _matcher(chunk)
+
+
+def _apply_chunk(task):
+    func, chunk = task
+    return [func(item) for item in chunk]
+
+
+def get_context():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def map_parallel(func, items, n_workers=None, chunksize=1000, initializer=None):
+    '''
+        Применяет func (функцию уровня модуля) к каждому элементу списка items в n_workers процессах,
+        элементы передаются кусками по chunksize. Возвращает список результатов в исходном порядке.
+        initializer вызывается один раз в каждом процессе, например, чтобы построить тяжёлые объекты.
+    '''
+    n_workers = n_workers or os.cpu_count()
+    if n_workers == 1 or len(items) <= chunksize:
+        if initializer is not None:
+            initializer()
+        return [func(item) for item in items]
+    chunks = ((func, items[start:start + chunksize]) for start in range(0, len(items), chunksize))
+    with get_context().Pool(n_workers, initializer) as pool:
+        return [result for chunk in pool.imap(_apply_chunk, chunks) for result in chunk]
+
+
+def get_chunks(data, chunksize):
+    for start in range(0, len(data), chunksize):
+        yield data.iloc[start:start + chunksize]
+
+
+def normalize_parallel(matcher, data, n_workers=None, chunksize=10000):
+    '''
+        Нормализует data (pd.DataFrame или pd.Series) матчером в n_workers процессах.
+        Данные режутся на куски по chunksize строк, куски проходят через пул процессов,
+        результаты собираются в исходном порядке.
+        Рабочие процессы создаются через fork после построения индексов матчера, поэтому эталон,
+        словари и матрицы не копируются в каждый процесс, а разделяются с родителем (copy-on-write).
+        Там, где fork недоступен, матчер передаётся каждому процессу один раз.
+        Счётчики и кэши, накопленные в рабочих процессах, в родительский матчер не возвращаются.
+    '''
+    global _matcher
+    n_workers = n_workers or os.cpu_count()
+    if n_workers == 1 or len(data) <= chunksize:
+        return matcher(data)
+
+    context = get_context()
+    if context.get_start_method() == 'fork':
+        _matcher = matcher
+        initializer, initargs = None, ()
+    else:
+        initializer, initargs = _init_worker, (matcher,)
+    try:
+        with context.Pool(n_workers, initializer, initargs) as pool:
+            results = list(pool.imap(_process_chunk, get_chunks(data, chunksize)))
+    finally:
+        _matcher = None
+
+    if isinstance(data, pd.Series):
+        return pd.concat(results, ignore_index=True)
+    return pd.concat(results)
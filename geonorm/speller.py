@@ -0,0 +1,285 @@
+import os
+import re
+import logging
+import shelve
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from rapidfuzz.distance import Levenshtein
+from .cache import LRUCache
+
+
+YANDEX_SPELLER_URL = 'https://speller.yandex.net/services/spellservice.json'
+
+
+def apply_hints(level, hints):
+    '''
+        Заменяет в level слова, для которых спеллер вернул исправление.
+        hints - список подсказок в формате Яндекс Спеллера: [{'word': 'Иркутскя', 's': ['Иркутская']}, ...]
+    '''
+    level_split = re.split('-| ', level)
+    for word in level_split:
+        for hint in hints:
+            if word == hint['word'] and hint['s']:
+                level = re.sub(word, hint['s'][0], level)
+    return level
+
+
+class YandexSpeller:
+    '''
+        Проверка орфографии через HTTP API Яндекс Спеллера.
+        url - адрес сервиса без метода, можно направить на локальную заглушку с тем же API
+        (url/checkText?text=... и url/checkTexts с несколькими text, ответ - списки подсказок).
+        Соединения переиспользуются через requests.Session, у каждого запроса есть timeout.
+        check_many отправляет тексты пачками по batch_size, не более max_workers запросов одновременно.
+        context = True: спеллеру отправляется строка с контекстом (весь адрес или уровень + ', улица').
+    '''
+    context = True
+    warning_limit_text = 'Закончился лимит подключения, используется оригинальная строка'
+
+    def __init__(self, url=YANDEX_SPELLER_URL, timeout=5, session=None, batch_size=50, max_workers=4):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    def check(self, text):
+        hints = self.check_many([text])[0]
+        return [] if hints is None else hints
+
+    def check_many(self, texts):
+        '''
+            Подсказки для каждого текста; None для текстов, которые проверить не удалось.
+        '''
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1:
+            return self.check_batch(batches[0])
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            return [hints for batch in pool.map(self.check_batch, batches) for hints in batch]
+
+    def check_batch(self, texts):
+        try:
+            if len(texts) == 1:
+                response = self.session.get(f'{self.url}/checkText', params={'text': texts[0]}, timeout=self.timeout)
+                return [response.json()]
+            response = self.session.post(f'{self.url}/checkTexts', data={'text': texts}, timeout=self.timeout)
+            result = response.json()
+            if len(result) != len(texts):
+                raise ValueError('speller response size mismatch')
+            return result
+        except Exception:
+            logging.warning(self.warning_limit_text)
+            return [None] * len(texts)
+
+
+class LocalSpeller:
+    '''
+        Офлайн-спеллер по словарю топонимов эталона.
+        Кандидаты ищутся методом symmetric delete (как в SymSpell): для каждого слова словаря заранее
+        строятся все варианты с удалением до max_distance букв из первых prefix_length букв,
+        у проверяемого слова - то же самое, совпавшие варианты дают кандидатов.
+        Из кандидатов выбирается ближайший по расстоянию Левенштейна, при равенстве - самый частый в эталоне.
+        check(text) возвращает подсказки в том же формате, что и Яндекс Спеллер.
+    '''
+    context = False
+
+    def __init__(self, words, max_distance=2, prefix_length=7, min_length=3):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.min_length = min_length
+        counts = Counter()
+        forms = {}
+        for word in words:
+            lower = word.lower()
+            counts[lower] += 1
+            forms.setdefault(lower, Counter())[word] += 1
+        self.counts = counts
+        # написание слова, которое чаще всего встречается в эталоне
+        self.forms = {lower: variants.most_common(1)[0][0] for lower, variants in forms.items()}
+        self.deletes = {}
+        for word in counts:
+            for variant in self.get_deletes(word):
+                self.deletes.setdefault(variant, []).append(word)
+
+    @classmethod
+    def from_standard(cls, standard, columns, **kwargs):
+        '''
+            Словарь строится из слов значений столбцов columns эталона.
+        '''
+        words = []
+        for column in columns:
+            for value in standard[column].unique():
+                words.extend(tokenize(str(value)))
+        return cls(words, **kwargs)
+
+    def get_deletes(self, word):
+        word = word[:self.prefix_length]
+        result = {word}
+        current = {word}
+        for _ in range(self.max_distance):
+            current = {variant[:i] + variant[i + 1:] for variant in current for i in range(len(variant))}
+            result |= current
+        return result
+
+    def correct(self, word):
+        '''
+            Исправление слова или None, если слово есть в словаре или близких слов не нашлось.
+        '''
+        lower = word.lower()
+        if lower in self.counts or len(lower) < self.min_length:
+            return None
+        candidates = set()
+        for variant in self.get_deletes(lower):
+            candidates.update(self.deletes.get(variant, ()))
+        best = None
+        best_key = None
+        for candidate in candidates:
+            distance = Levenshtein.distance(lower, candidate, score_cutoff=self.max_distance)
+            if distance > self.max_distance:
+                continue
+            key = (distance, -self.counts[candidate], candidate)
+            if best_key is None or key < best_key:
+                best, best_key = candidate, key
+        return None if best is None else self.forms[best]
+
+    def check(self, text):
+        hints = []
+        for word in tokenize(text):
+            suggestion = self.correct(word)
+            if suggestion is not None:
+                hints.append({'word': word, 's': [suggestion]})
+        return hints
+
+    def check_many(self, texts):
+        return [self.check(text) for text in texts]
+
+
+class CachedSpeller:
+    '''
+        Кэш ответов спеллера: LRU в памяти (maxsize записей) и, если задан path, файл shelve на диске,
+        который переживает перезапуски. Ключ - текст, отправленный спеллеру.
+        prefetch(texts) заранее проверяет пачкой все тексты, которых нет в кэше.
+        Неудачные запросы (None от check_many) не кэшируются.
+        stats(): hits - тексты, найденные в памяти или на диске, misses - тексты, отправленные спеллеру.
+        Файл на диске используется только процессом, который его открыл: процессы, созданные
+        через fork (normalize_parallel), работают с унаследованной копией кэша в памяти,
+        а при сериализации (spawn) копия получает кэш в памяти без файла.
+    '''
+    def __init__(self, backend, maxsize=100000, path=None):
+        self.backend = backend
+        self.context = getattr(backend, 'context', True)
+        self.cache = LRUCache(maxsize=maxsize)
+        self.path = path
+        self.store = shelve.open(str(path)) if path is not None else None
+        self.store_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stats_lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('store', 'store_lock', 'stats_lock'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.store = None
+        self.store_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+
+    def has_store(self):
+        return self.store is not None and os.getpid() == self.pid
+
+    def check(self, text):
+        hints = self.cache.get(text)
+        if hints is None:
+            hints = self.from_store(text)
+        if hints is not None:
+            self.count(hits=1)
+            return hints
+        hints = self.request([text])[0]
+        return [] if hints is None else hints
+
+    def prefetch(self, texts):
+        '''
+            Каждый уникальный текст учитывается как обращение к кэшу: тексты, которые придётся отправить спеллеру,
+            считаются промахами здесь, а не попаданиями при следующей построчной обработке.
+        '''
+        texts = list(dict.fromkeys(texts))
+        missed = [text for text in texts if text not in self.cache]
+        missed = [text for text in missed if self.from_store(text) is None]
+        self.count(hits=len(texts) - len(missed))
+        if missed:
+            self.request(missed)
+
+    def from_store(self, text):
+        if not self.has_store():
+            return None
+        with self.store_lock:
+            hints = self.store.get(text)
+        if hints is not None:
+            self.cache.put(text, hints)
+        return hints
+
+    def request(self, texts):
+        self.count(misses=len(texts))
+        if hasattr(self.backend, 'check_many'):
+            results = self.backend.check_many(texts)
+        else:
+            results = [self.backend.check(text) for text in texts]
+        for text, hints in zip(texts, results):
+            if hints is None:
+                continue
+            self.cache.put(text, hints)
+            if self.has_store():
+                with self.store_lock:
+                    self.store[text] = hints
+        return results
+
+    def count(self, hits=0, misses=0):
+        with self.stats_lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(
+            self.cache.stats(),
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hits / lookups if lookups else 0
+        )
+
+    def close(self):
+        if self.has_store():
+            with self.store_lock:
+                self.store.close()
+            self.store = None
+
+
+def tokenize(text):
+    return [word for word in re.split(r'[^\w]+', text) if word and not word.isdigit()]
+
+
+def get_speller(speller, standard=None, columns=None, cache_size=None, cache_path=None):
+    '''
+        Возвращает объект спеллера с методом check(text).
+        speller - 'local' (офлайн по словарю эталона), 'yandex' или готовый объект с методом check.
+        Если задан cache_size или cache_path, спеллер оборачивается в CachedSpeller.
+    '''
+    if speller == 'local':
+        speller = LocalSpeller.from_standard(standard, columns)
+    elif speller == 'yandex':
+        speller = YandexSpeller()
+    if cache_size or cache_path is not None:
+        speller = CachedSpeller(speller, maxsize=cache_size, path=cache_path)
+    return speller
@@ -0,0 +1,215 @@
+import os
+import json
+import pathlib
+import logging
+import pandas as pd
+
+
+'''
+    Потоковая нормализация больших файлов: входной файл читается кусками,
+    каждый кусок декомпозируется (если задан столбец с адресной строкой), нормализуется
+    и сразу дописывается в выходной файл. После каждого куска обновляется файл контрольной точки,
+    по которому прерванная обработка продолжается с первой необработанной строки.
+'''
+
+
+def get_format(path, output_format=None):
+    if output_format:
+        return output_format
+    return 'parquet' if str(path).endswith('.parquet') else 'csv'
+
+
+def read_chunks(path, chunksize, sep=';', skip_rows=0):
+    '''
+        Читает CSV или Parquet кусками по chunksize строк, пропуская первые skip_rows строк.
+        Значения читаются строками, пустые значения - пустые строки.
+    '''
+    if get_format(path) == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('для чтения parquet нужен pyarrow: pip install pyarrow')
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunksize):
+            if skip_rows >= batch.num_rows:
+                skip_rows -= batch.num_rows
+                continue
+            yield batch.slice(skip_rows).to_pandas().fillna('')
+            skip_rows = 0
+        return
+    reader = pd.read_csv(
+        path,
+        sep=sep,
+        dtype=str,
+        keep_default_na=False,
+        chunksize=chunksize,
+        # пропущенные строки не разбираются
+        skiprows=range(1, skip_rows + 1) if skip_rows else None
+    )
+    with reader:
+        for chunk in reader:
+            yield chunk
+
+
+class Checkpoint:
+    '''
+        Контрольная точка в файле <output>.checkpoint: входной файл и chunksize, с которыми она записана,
+        число обработанных строк и кусков, размер выходного CSV после последнего завершённого куска
+        и столбцы результата. Продолжить можно только тот же входной файл с тем же chunksize.
+    '''
+    def __init__(self, output_path, input_path, chunksize):
+        self.path = pathlib.Path(f'{output_path}.checkpoint')
+        self.input = str(pathlib.Path(input_path).resolve())
+        self.chunksize = chunksize
+        self.rows = 0
+        self.chunks = 0
+        self.offset = 0
+        self.columns = None
+
+    def load(self):
+        if self.path.exists():
+            with open(self.path, 'r', encoding='utf-8') as fp:
+                state = json.load(fp)
+            if state.get('input') != self.input or state.get('chunksize') != self.chunksize:
+                raise ValueError(
+                    f'контрольная точка {self.path} записана для файла {state.get("input")} '
+                    f'с chunksize={state.get("chunksize")}, а не {self.input} с chunksize={self.chunksize}; '
+                    f'запустите с resume=False (--no-resume), чтобы начать заново'
+                )
+            self.rows = state['rows']
+            self.chunks = state['chunks']
+            self.offset = state['offset']
+            self.columns = state['columns']
+        return self
+
+    def save(self):
+        state = {
+            'input': self.input,
+            'chunksize': self.chunksize,
+            'rows': self.rows,
+            'chunks': self.chunks,
+            'offset': self.offset,
+            'columns': self.columns
+        }
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            json.dump(state, fp, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if self.path.exists():
+            self.path.unlink()
+
+
+class CsvWriter:
+    '''
+        Дописывает куски в CSV. При продолжении файл обрезается до размера из контрольной точки,
+        так что строки незавершённого куска не дублируются.
+    '''
+    def __init__(self, path, offset=0, sep=';'):
+        self.sep = sep
+        self.file = open(path, 'r+b' if offset and os.path.exists(path) else 'wb')
+        self.file.truncate(offset)
+        self.file.seek(offset)
+
+    def write(self, df):
+        self.file.write(df.to_csv(sep=self.sep, index=False, header=self.file.tell() == 0).encode('utf-8'))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    '''
+        Пишет каждый кусок отдельным файлом part-<номер>.parquet в директорию path,
+        так что завершённые куски не переписываются при продолжении.
+    '''
+    def __init__(self, path, chunk=0):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('для записи parquet нужен pyarrow: pip install pyarrow')
+        self.pyarrow = pyarrow
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.chunk = chunk
+
+    def write(self, df):
+        table = self.pyarrow.Table.from_pandas(df.astype(str), preserve_index=False)
+        self.pyarrow.parquet.write_table(table, self.path / f'part-{self.chunk:05d}.parquet')
+        self.chunk += 1
+        return 0
+
+    def close(self):
+        pass
+
+
+def decompose_chunk(addresses, n_workers=1):
+    '''
+        Декомпозиция адресных строк куска в датафрейм уровней.
+    '''
+    from .natasha_decompose import decompose_batch
+    return decompose_batch(addresses, n_workers, max(1, -(-len(addresses) // (4 * n_workers))))
+
+
+def normalize_file(matcher, input_path, output_path, chunksize=100000, address_column=None,
+                   keep_columns=None, sep=';', output_format=None, n_workers=1, resume=True):
+    '''
+        Нормализует файл input_path (CSV или Parquet) матчером (Geonormaliser или Geomatch) кусками
+        по chunksize строк и дописывает результат в output_path (CSV или директория с Parquet-файлами).
+        address_column - столбец с адресной строкой, которая сначала декомпозируется;
+        если не задан, уровни адреса берутся из одноимённых столбцов входного файла.
+        keep_columns - столбцы входного файла, которые переносятся в результат (например, идентификатор).
+        n_workers > 1 - декомпозиция и нормализация каждого куска идут в нескольких процессах.
+        При resume=True обработка продолжается с контрольной точки <output_path>.checkpoint;
+        если она записана для другого входного файла или chunksize, возбуждается ValueError.
+        Возвращает число обработанных строк.
+    '''
+    output_format = get_format(output_path, output_format)
+    checkpoint = Checkpoint(output_path, input_path, chunksize)
+    if resume:
+        checkpoint.load()
+    if checkpoint.rows:
+        logging.info(f'resume from row {checkpoint.rows} (chunk {checkpoint.chunks})')
+
+    keep_columns = list(keep_columns or [])
+    if address_column and address_column not in keep_columns:
+        keep_columns.insert(0, address_column)
+
+    if output_format == 'parquet':
+        writer = ParquetWriter(output_path, checkpoint.chunks)
+    else:
+        writer = CsvWriter(output_path, checkpoint.offset, sep)
+
+    rows = 0
+    try:
+        for chunk in read_chunks(input_path, chunksize, sep, checkpoint.rows):
+            if address_column:
+                levels = decompose_chunk(chunk[address_column], n_workers)
+            else:
+                levels = chunk
+            if n_workers > 1:
+                result = matcher.normalize_parallel(levels, n_workers, max(1, -(-len(levels) // n_workers)))
+            else:
+                result = matcher(levels)
+            result.index = chunk.index
+            result = pd.concat([chunk[keep_columns], result], axis=1)
+            # столбцы всех кусков как у первого, чтобы файл оставался однородным
+            if checkpoint.columns is None:
+                checkpoint.columns = result.columns.tolist()
+            result = result.reindex(columns=checkpoint.columns)
+
+            checkpoint.offset = writer.write(result)
+            checkpoint.rows += len(chunk)
+            checkpoint.chunks += 1
+            checkpoint.save()
+            rows += len(chunk)
+            logging.info(f'chunk {checkpoint.chunks}: {checkpoint.rows} rows')
+    finally:
+        writer.close()
+    checkpoint.remove()
+    return rows
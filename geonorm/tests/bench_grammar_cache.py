@@ -0,0 +1,52 @@
+import os
+import sys
+import json
+import tempfile
+import subprocess
+
+'''
+    Время запуска экстрактора адресов без кэша грамматики (cold) и с кэшем (warm).
+    Каждый замер - отдельный процесс python, кэш лежит во временной директории.
+'''
+
+ROOT_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+repeats = 3
+probe = '''
+import json, time
+start = time.time()
+from geonorm import natasha_decompose
+imported = time.time()
+natasha_decompose.get_morph_vocab()
+morph = time.time()
+natasha_decompose.get_address_extractor()
+extractor = time.time()
+natasha_decompose.decompose('г Москва, ул Ленина, д 5')
+print(json.dumps({
+    'import': imported - start,
+    'extractor': extractor - morph,
+    'total': time.time() - start
+}))
+'''
+
+
+def run(cache_dir):
+    env = dict(os.environ, GEONORM_CACHE_DIR=cache_dir)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT_DIRECTORY, env.get('PYTHONPATH')]))
+    output = subprocess.run([sys.executable, '-c', probe], env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def report(name, results):
+    means = {key: sum(result[key] for result in results) / len(results) for key in results[0]}
+    print(f"{name}: import {means['import']:.3f}s, extractor {means['extractor']:.3f}s, total {means['total']:.3f}s")
+
+
+cold = []
+warm = []
+for _ in range(repeats):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cold.append(run(cache_dir))
+        warm.append(run(cache_dir))
+
+report('cold', cold)
+report('warm', warm)
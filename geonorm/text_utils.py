@@ -1,17 +1,81 @@
+import sys
 import json
 import re
 import pathlib
+import numpy as np
+import pandas as pd
 
 
 with open(str(pathlib.Path(__file__).parent.resolve()) + '/descriptors_config.json', 'r', encoding='utf-8') as fp:
     descriptors_to_remove = json.load(fp).get('descriptors_to_remove')
 
 
+def compile_descriptors(descriptors):
+    """
+    Один шаблон на все дескрипторы уровня: дескриптор как отдельное слово, длинные варианты раньше коротких
+    """
+    if not descriptors:
+        return None
+    alternation = '|'.join(re.escape(descriptor) for descriptor in sorted(set(descriptors), key=len, reverse=True))
+    return re.compile(r'(?<!\w)(?:' + alternation + r')(?!\w)')
+
+
+descriptors_patterns = {key: compile_descriptors(descriptors) for key, descriptors in descriptors_to_remove.items()}
+
+
 def remove_descriptors(key, level):
-    if key in descriptors_to_remove:
-        for descriptor in descriptors_to_remove[key]:
-            level = level.replace('.', ' ')
-            level = re.sub(r'(^|[^\w])' + descriptor + r'([^\w]|$)', r'\1' + '' + r'\2', level)
-            level = level.strip()
+    pattern = descriptors_patterns.get(key)
+    if pattern is not None:
+        level = pattern.sub('', level.replace('.', ' ')).strip()
     return level
 
+
+def remove_descriptors_series(key, series):
+    """
+    remove_descriptors для целого столбца строк
+    """
+    pattern = descriptors_patterns.get(key)
+    if pattern is None:
+        return series
+    return series.str.replace('.', ' ', regex=False).str.replace(pattern, '', regex=True).str.strip()
+
+
+def fold_text(value):
+    """
+    Форма значения для буквального сравнения: нижний регистр, ё -> е, пробелы схлопнуты.
+    В отличие от normalize_text знаки препинания и дескрипторы сохраняются
+    """
+    return ' '.join(str(value).lower().replace('ё', 'е').split())
+
+
+def prepare_text(text):
+    return text.casefold().replace('ё', 'е').replace('.', ' ')
+
+
+canonical_descriptors_patterns = {
+    key: compile_descriptors([prepare_text(descriptor) for descriptor in descriptors])
+    for key, descriptors in descriptors_to_remove.items()
+}
+punctuation_pattern = re.compile(r'[\W_]+')
+
+
+def normalize_text(value, key=None):
+    """
+    Каноническая форма значения для точного сравнения: нижний регистр, ё -> е, без дескрипторов уровня key
+    и знаков препинания, пробелы схлопнуты. Строка интернируется, одинаковые формы - один объект
+    """
+    text = prepare_text(str(value))
+    pattern = canonical_descriptors_patterns.get(key)
+    if pattern is not None:
+        text = pattern.sub('', text)
+    return sys.intern(' '.join(punctuation_pattern.sub(' ', text).split()))
+
+
+def normalize_series(key, series):
+    """
+    normalize_text для столбца: каждое уникальное значение нормализуется один раз
+    """
+    codes, uniques = pd.factorize(series)
+    # последний элемент - для пропусков (код -1)
+    normalized = np.array([normalize_text(value, key) for value in uniques] + [''], dtype=object)
+    return pd.Series(normalized[codes], index=series.index, dtype=object)
@@ -20,5 +20,7 @@ setuptools.setup(
     include_package_data=True,
     package_data={'ovrazhki': ['ovrazhki/*.csv'], 'geonorm': ['geonorm/*.json', 'geonorm/*.csv', '*.json']},
     packages=['ovrazhki', 'geonorm', 'geonorm.nat_new', 'geonorm.nat_new.grammars'],
-    install_requires=required
+    install_requires=required,
+    extras_require={'parquet': ['pyarrow']},
+    entry_points={'console_scripts': ['geonorm=geonorm.cli:main']}
 )